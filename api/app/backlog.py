@@ -0,0 +1,29 @@
+import asyncio
+from common.observability import log_event, metrics
+from common.streams import stream_stats
+
+
+async def watch_backlog(state, targets, group, interval):
+    """
+    Refresh state.stream_lag and the backlog gauges in the background so
+    /webhook can shed load without an extra Redis call per request.
+    targets: [(redis client, stream key)], one per shard; gauges are totals.
+    """
+    while True:
+        total_length = total_lag = total_pending = 0
+        for redis, stream in targets:
+            try:
+                length, lag, pending = await stream_stats(redis, stream, group)
+            except Exception as e:
+                # stream/group not created yet (worker not started) is expected at boot
+                log_event("backlog_error", stream=stream, error=str(e))
+                continue
+            metrics["redis_stream_shard_lag"].labels(stream=stream).set(lag)
+            total_length += length
+            total_lag += lag
+            total_pending += pending
+        state.stream_lag = total_lag
+        metrics["redis_stream_length"].set(total_length)
+        metrics["redis_group_lag"].set(total_lag)
+        metrics["redis_messages_pending"].set(total_pending)
+        await asyncio.sleep(interval)
@@ -0,0 +1,30 @@
+import time
+
+
+class TTLCache:
+    """
+    Small in-process cache. Entries expire after `ttl` seconds and are also
+    dropped when the `version` they were stored under no longer matches.
+    """
+
+    def __init__(self, ttl=30.0, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}
+
+    def get(self, key, version):
+        hit = self.entries.get(key)
+        if hit is None:
+            return None
+        stored_version, expires, value = hit
+        if stored_version != version or expires < time.monotonic():
+            self.entries.pop(key, None)
+            return None
+        return value
+
+    def set(self, key, version, value):
+        if len(self.entries) >= self.max_entries:
+            # evict the entry closest to expiry
+            oldest = min(self.entries, key=lambda k: self.entries[k][1])
+            self.entries.pop(oldest, None)
+        self.entries[key] = (version, time.monotonic() + self.ttl, value)
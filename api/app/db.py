@@ -1,12 +1,5 @@
-import os, asyncpg
-from typing import Optional
-
-DATABASE_URL = os.getenv("DATABASE_URL")
-
-_pool = None
+from common.resources import get_db_pool
 
 async def get_pool():
-    global _pool
-    if _pool is None:
-        _pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=10)
-    return _pool
+    # process-lifetime pool (DB_POOL_MAX_SIZE, default 10), see common/resources.py
+    return await get_db_pool("api", default_max=10)
@@ -0,0 +1,86 @@
+from common.observability import log_event
+
+KEY_PREFIX = "dedupe:msg"
+
+# claim states: first sighting, accepted by an earlier request, or an earlier request still archiving/queueing it
+NEW = "new"
+DONE = "done"
+PENDING = "pending"
+
+
+def message_id(data):
+    # same precedence as the worker's msg_id column
+    message = data.get("message") or {}
+    msg_id = (message.get("id") if isinstance(message, dict) else None) or data.get("msg_id")
+    return str(msg_id) if msg_id not in (None, "") else None
+
+
+def dedupe_key(channel, msg_id):
+    return f"{KEY_PREFIX}:{channel}:{msg_id}"
+
+
+async def claim(redis, keys, pending_ttl):
+    """
+    SET NX every key to "pending" (None = no message id, always NEW) and read
+    back its value. Returns one state per key: NEW for the first sighting,
+    DONE once an earlier request queued the message (mark_done), PENDING
+    while an earlier request is still on it. The pending mark expires after
+    `pending_ttl` seconds in case that request dies before marking it done.
+    A repeat of a key within `keys` is DONE: it rides on the first one.
+    Fails open: if Redis errors every message counts as NEW.
+    """
+    wanted = [k for k in keys if k is not None]
+    if not wanted:
+        return [NEW] * len(keys)
+    try:
+        pipe = redis.pipeline(transaction=False)
+        for key in wanted:
+            pipe.set(key, PENDING, nx=True, ex=pending_ttl)
+            pipe.get(key)
+        replies = iter(await pipe.execute())
+    except Exception as e:
+        log_event("dedupe_error", error=str(e))
+        return [NEW] * len(keys)
+
+    states = []
+    seen = set()
+    for key in keys:
+        if key is None:
+            states.append(NEW)
+            continue
+        claimed, value = next(replies), next(replies)
+        if key in seen:
+            states.append(DONE)
+        elif claimed:
+            states.append(NEW)
+        else:
+            # None: the pending mark expired in between, let the retry decide
+            states.append(DONE if value == DONE.encode() else PENDING)
+        seen.add(key)
+    return states
+
+
+async def mark_done(redis, keys, ttl):
+    """Messages are in the stream: retries within `ttl` seconds are duplicates from now on."""
+    keys = [k for k in keys if k is not None]
+    if not keys:
+        return
+    try:
+        pipe = redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.set(key, DONE, ex=ttl)
+        await pipe.execute()
+    except Exception as e:
+        # the pending mark expires and the next retry is queued again; the worker's msg_id index dedupes it
+        log_event("dedupe_error", error=str(e))
+
+
+async def release(redis, keys):
+    """Forget claimed keys of messages that were not accepted after all, so the CRM retry goes through."""
+    keys = [k for k in keys if k is not None]
+    if not keys:
+        return
+    try:
+        await redis.delete(*keys)
+    except Exception as e:
+        log_event("dedupe_error", error=str(e))
@@ -0,0 +1,160 @@
+import io, csv, datetime
+
+EXPORT_COLUMNS = [
+    "id", "room_id", "leads_date", "channel", "phone",
+    "booking_date", "transaction_date", "transaction_value", "opening_keyword",
+]
+
+FUNNEL_EXPORT_SQL = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM funnel ORDER BY leads_date"
+
+# a funnel row missing any of these goes to the reject report
+REQUIRED_COLUMNS = [
+    "leads_date", "phone", "booking_date", "transaction_date", "transaction_value", "opening_keyword",
+]
+_REQUIRED_IDX = [EXPORT_COLUMNS.index(c) for c in REQUIRED_COLUMNS]
+
+FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+
+def is_reject(row):
+    return any(row[i] is None for i in _REQUIRED_IDX)
+
+
+class ChunkBuffer:
+    """
+    Write-only file object that hands back whatever was written since the
+    last drain(), so encoded output can be streamed out in pieces.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class CsvSink:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.text = io.StringIO()
+        self.writer = csv.writer(self.text)
+        self.writer.writerow(EXPORT_COLUMNS)
+        self.rows = 0
+
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+        self.fileobj.write(self.text.getvalue().encode("utf-8"))
+        self.text.seek(0)
+        self.text.truncate()
+        self.rows += len(rows)
+
+    def close(self):
+        if self.text.tell():
+            self.fileobj.write(self.text.getvalue().encode("utf-8"))
+
+
+class ParquetSink:
+    """
+    One parquet row group per write_rows() call, so memory stays bounded by the chunk size.
+    """
+
+    def __init__(self, fileobj):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("parquet export needs pyarrow installed")
+        self.pa = pa
+        self.schema = pa.schema([
+            ("id", pa.int64()),
+            ("room_id", pa.int64()),
+            ("leads_date", pa.date32()),
+            ("channel", pa.string()),
+            ("phone", pa.string()),
+            ("booking_date", pa.date32()),
+            ("transaction_date", pa.date32()),
+            ("transaction_value", pa.float64()),
+            ("opening_keyword", pa.string()),
+        ])
+        self.writer = pq.ParquetWriter(fileobj, self.schema, compression="snappy")
+        self.rows = 0
+
+    def write_rows(self, rows):
+        if not rows:
+            return
+        columns = [list(c) for c in zip(*rows)]
+        value_idx = EXPORT_COLUMNS.index("transaction_value")
+        columns[value_idx] = [float(v) if v is not None else None for v in columns[value_idx]]
+        self.writer.write_table(self.pa.Table.from_arrays(columns, schema=self.schema))
+        self.rows += len(rows)
+
+    def close(self):
+        self.writer.close()
+
+
+def format_available(fmt):
+    if fmt == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            return False
+    return fmt in FORMATS
+
+
+def make_sink(fmt, fileobj):
+    if fmt == "csv":
+        return CsvSink(fileobj)
+    if fmt == "parquet":
+        return ParquetSink(fileobj)
+    raise ValueError(f"unknown export format {fmt}")
+
+
+def export_filename(kind, fmt):
+    return f"funnel_{kind}_{datetime.date.today().isoformat()}.{FORMATS[fmt][1]}"
+
+
+async def stream_funnel(pool, fmt, rejects_only=False, chunk_rows=5000):
+    """
+    Async generator of encoded export bytes. Rows come through a server-side
+    cursor in chunks of chunk_rows, so memory does not grow with the table.
+    """
+    buffer = ChunkBuffer()
+    sink = make_sink(fmt, buffer)
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            cursor = await conn.cursor(FUNNEL_EXPORT_SQL)
+            while True:
+                records = await cursor.fetch(chunk_rows)
+                if not records:
+                    break
+                rows = [tuple(r) for r in records]
+                if rejects_only:
+                    rows = [r for r in rows if is_reject(r)]
+                sink.write_rows(rows)
+                data = buffer.drain()
+                if data:
+                    yield data
+    sink.close()
+    yield buffer.drain()
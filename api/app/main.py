@@ -1,10 +1,19 @@
-import os, json, uuid, datetime
-from fastapi import FastAPI, Request, HTTPException
-import redis.asyncio as redis
-from .utils_s3 import get_s3_client, ensure_bucket
+import os, hmac, zlib, uuid, asyncio, datetime
+from fastapi import FastAPI, Request, Response, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from typing import Optional
+from .utils_s3 import get_s3_client, ensure_bucket, S3Archiver
 from .db import get_pool
-import io
-from .utils.observability import log_event, metrics, start_metrics_server
+from .backlog import watch_backlog
+from .cache import TTLCache
+from . import dedupe
+from .export import FORMATS, format_available, stream_funnel, export_filename
+from common.observability import log_event, metrics, start_metrics_server, timed
+from common import fastjson, profiling
+from common.funnel import ROLLUP_VERSION_KEY
+from common.keywords import CATEGORIES, apply_keywords
+from common.resources import close_all, get_redis, watch_resources
+from common.streams import STREAM_BASE, STREAM_GROUP, STREAM_REDIS_URLS, STREAM_SHARDS, all_shards, node_for, shard_for, stream_key
 
 REDIS_URL = os.getenv("REDIS_URL")
 MINIO_ENDPOINT = os.getenv("MINIO_ENDPOINT")
@@ -12,73 +21,344 @@ MINIO_ACCESS_KEY = os.getenv("MINIO_ACCESS_KEY")
 MINIO_SECRET_KEY = os.getenv("MINIO_SECRET_KEY")
 RAW_BUCKET = os.getenv("RAW_BUCKET", "raw-payloads")
 
+# sync: ack after the S3 PUT; write_behind: ack after XADD, archive from a local buffer
+ARCHIVE_MODE = os.getenv("ARCHIVE_MODE", "sync")
+S3_UPLOAD_THREADS = int(os.getenv("S3_UPLOAD_THREADS", "16"))
+S3_MAX_INFLIGHT = int(os.getenv("S3_MAX_INFLIGHT", "64"))
+S3_ACQUIRE_TIMEOUT = float(os.getenv("S3_ACQUIRE_TIMEOUT", "5"))
+ARCHIVE_BUFFER_SIZE = int(os.getenv("ARCHIVE_BUFFER_SIZE", "10000"))
+# payloads up to this size also ride inside the stream entry so the worker skips S3 (0 = off)
+INLINE_PAYLOAD_MAX_BYTES = int(os.getenv("INLINE_PAYLOAD_MAX_BYTES", "8192"))
+INLINE_PAYLOAD_COMPRESS = os.getenv("INLINE_PAYLOAD_COMPRESS", "0") == "1"
+
+# shed /webhook load with BACKPRESSURE_STATUS + Retry-After once group lag passes this (0 = off)
+BACKPRESSURE_LAG_THRESHOLD = int(os.getenv("BACKPRESSURE_LAG_THRESHOLD", "0"))
+BACKPRESSURE_STATUS = int(os.getenv("BACKPRESSURE_STATUS", "503"))
+BACKPRESSURE_RETRY_AFTER = os.getenv("BACKPRESSURE_RETRY_AFTER", "5")
+BACKLOG_POLL_SECONDS = float(os.getenv("BACKLOG_POLL_SECONDS", "2"))
+WEBHOOK_BATCH_MAX_ITEMS = int(os.getenv("WEBHOOK_BATCH_MAX_ITEMS", "10000"))
+
+# a (channel, message id) seen again within this many seconds is answered as a duplicate (0 = off)
+DEDUPE_TTL_SECONDS = int(os.getenv("DEDUPE_TTL_SECONDS", "86400"))
+# while a message is being archived/queued its retries get 409 + Retry-After; the mark expires after this
+DEDUPE_PENDING_TTL_SECONDS = int(os.getenv("DEDUPE_PENDING_TTL_SECONDS", "60"))
+DEDUPE_RETRY_AFTER = os.getenv("DEDUPE_RETRY_AFTER", "1")
+
+REPORT_CACHE_TTL = float(os.getenv("REPORT_CACHE_TTL", "60"))
+
+# GET /export/funnel exists only when set, and requires a matching X-Export-Token header
+EXPORT_TOKEN = os.getenv("EXPORT_TOKEN")
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "5000"))
+
+# POST /debug/profile exists only when set, and requires a matching X-Profiling-Token header
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN")
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+
 app = FastAPI(title="Sparks Ingest API")
 
 @app.on_event("startup")
 async def startup():
-    app.state.redis = await redis.from_url(REDIS_URL)
+    app.state.redis = get_redis(REDIS_URL)
+    # Redis nodes holding the stream shards (just REDIS_URL unless STREAM_REDIS_URLS is set)
+    app.state.stream_nodes = [get_redis(url) for url in STREAM_REDIS_URLS] or [app.state.redis]
     app.state.s3 = get_s3_client(MINIO_ENDPOINT, MINIO_ACCESS_KEY, MINIO_SECRET_KEY)
     ensure_bucket(app.state.s3, RAW_BUCKET)
+    app.state.archiver = S3Archiver(
+        app.state.s3, RAW_BUCKET,
+        threads=S3_UPLOAD_THREADS,
+        max_inflight=S3_MAX_INFLIGHT,
+        buffer_size=ARCHIVE_BUFFER_SIZE,
+        acquire_timeout=S3_ACQUIRE_TIMEOUT,
+    )
+    if ARCHIVE_MODE == "write_behind":
+        app.state.archiver.start()
     app.state.db = await get_pool()
+    app.state.stream_lag = 0
+    app.state.report_cache = TTLCache(ttl=REPORT_CACHE_TTL)
+    app.state.backlog_task = asyncio.create_task(
+        watch_backlog(app.state, stream_targets(), STREAM_GROUP, BACKLOG_POLL_SECONDS)
+    )
+    app.state.resources_task = asyncio.create_task(watch_resources())
+    app.state.profiling_task = profiling.install("api")
     
     start_metrics_server(7000)
     log_event("app_started")
 
 @app.on_event("shutdown")
 async def shutdown():
-    try:
-        await app.state.redis.close()
-    except:
-        pass
-    pool = getattr(app.state, "db", None)
-    if pool:
-        await pool.close()
+    archiver = getattr(app.state, "archiver", None)
+    if archiver:
+        await archiver.close()
+    # Redis clients and the Postgres pool
+    await close_all()
 
-@app.post("/webhook")
-async def webhook(request: Request):
-    try:
-        data = await request.json()
-    except Exception:
-        raise HTTPException(status_code=400, detail="invalid json")
+def check_backpressure():
+    if BACKPRESSURE_LAG_THRESHOLD and app.state.stream_lag > BACKPRESSURE_LAG_THRESHOLD:
+        metrics["webhook_rejected_backpressure"].inc()
+        raise HTTPException(
+            status_code=BACKPRESSURE_STATUS,
+            detail="ingest backlog, retry later",
+            headers={"Retry-After": BACKPRESSURE_RETRY_AFTER},
+        )
+
+def stream_target(shard):
+    return app.state.stream_nodes[node_for(shard)], stream_key(shard)
 
+def stream_targets():
+    targets = [stream_target(shard) for shard in all_shards()]
+    if STREAM_SHARDS > 0:
+        # the legacy stream's backlog still counts while the workers drain it
+        targets.append((app.state.redis, STREAM_BASE))
+    return targets
+
+def extract_route(data):
     channel = data.get("channel") or data.get("source") or "unknown"
     room_id = data.get("room_id") or data.get("room", {}).get("id") or data.get("roomId")
     if not room_id:
         room_id = f"room_unknown_{uuid.uuid4().hex[:8]}"
+    return channel, room_id
 
-    ts = datetime.datetime.utcnow().isoformat()
-    key_json = f"raw/{channel}/{room_id}/{ts}.json"
-    raw_bytes = io.BytesIO(json.dumps(data).encode("utf-8"))
-
-    try:
-        app.state.s3.put_object(
-            Bucket=RAW_BUCKET,
-            Key=key_json,
-            Body=raw_bytes,
-            ContentType="application/json"
-        )
-        log_event("s3_upload_success", key=key_json, channel=channel)
-    except Exception as e:
-        log_event("s3_upload_error", error=str(e))
-        raise HTTPException(status_code=500, detail="S3 put error")
-
-    stream_key = "incoming:messages"
+def stream_entry(channel, room_id, key, ts, raw_bytes, write_behind, offset=None):
     entry = {
         "provider": channel,
         "room_id": room_id,
-        "raw_object_key": key_json,
+        "raw_object_key": key,
         "received_at": ts
     }
+    if offset is not None:
+        # the object is a batch segment, this payload is raw_length bytes at raw_offset
+        entry["raw_offset"] = offset
+        entry["raw_length"] = len(raw_bytes)
+    # write-behind must always inline: the object may not be in MinIO yet when the worker picks this up
+    if write_behind or len(raw_bytes) <= INLINE_PAYLOAD_MAX_BYTES:
+        if INLINE_PAYLOAD_COMPRESS:
+            entry["raw_payload"] = zlib.compress(raw_bytes)
+            entry["payload_encoding"] = "zlib"
+        else:
+            entry["raw_payload"] = raw_bytes
+    return entry
+
+async def claim_messages(routes):
+    """
+    routes: [(channel, data)]. Returns (dedupe keys, claim states): DONE for
+    a CRM retry of a message already queued within DEDUPE_TTL_SECONDS,
+    PENDING while another request is still archiving/queueing it, NEW
+    otherwise. Messages without an id are never deduped.
+    """
+    if not DEDUPE_TTL_SECONDS:
+        return [None] * len(routes), [dedupe.NEW] * len(routes)
+    keys = []
+    for channel, data in routes:
+        msg_id = dedupe.message_id(data)
+        keys.append(dedupe.dedupe_key(channel, msg_id) if msg_id else None)
+    with timed("webhook_stage_seconds", stage="dedupe"):
+        states = await dedupe.claim(app.state.redis, keys, DEDUPE_PENDING_TTL_SECONDS)
+    suppressed = states.count(dedupe.DONE)
+    if suppressed:
+        metrics["webhook_duplicates_suppressed"].inc(suppressed)
+    in_flight = states.count(dedupe.PENDING)
+    if in_flight:
+        metrics["webhook_duplicates_in_flight"].inc(in_flight)
+    return keys, states
+
+async def accept_messages(keys):
+    """Queued: later retries are answered as duplicates."""
+    if DEDUPE_TTL_SECONDS:
+        await dedupe.mark_done(app.state.redis, keys, DEDUPE_TTL_SECONDS)
+
+async def archive_before_ack(key, body, channel):
+    try:
+        await app.state.archiver.put(key, body)
+        log_event("s3_upload_success", key=key, channel=channel)
+    except asyncio.TimeoutError:
+        log_event("s3_upload_busy", key=key)
+        raise HTTPException(status_code=503, detail="S3 busy", headers={"Retry-After": "1"})
+    except Exception as e:
+        log_event("s3_upload_error", error=str(e))
+        raise HTTPException(status_code=500, detail="S3 put error")
 
+async def archive_behind(key, body, channel):
+    if app.state.archiver.enqueue(key, body):
+        return
+    # buffer full: archive inline (still off the event loop) rather than drop
     try:
-        await app.state.redis.xadd(stream_key, entry)
-        metrics["redis_messages_total"].inc()
+        await app.state.archiver.put(key, body)
+        log_event("s3_upload_success", key=key, channel=channel)
     except Exception as e:
-        log_event("redis_xadd_error", error=str(e))
-        raise HTTPException(status_code=500, detail="Redis push error")
+        log_event("s3_upload_error", key=key, error=str(e))
+
+@app.post("/webhook")
+async def webhook(request: Request):
+    check_backpressure()
+
+    # the request bytes are archived and streamed verbatim, only parsed for routing
+    raw_bytes = await request.body()
+    try:
+        with timed("webhook_stage_seconds", stage="parse"):
+            data = fastjson.loads(raw_bytes)
+    except Exception:
+        raise HTTPException(status_code=400, detail="invalid json")
+
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=400, detail="payload is not a json object")
+
+    channel, room_id = extract_route(data)
+
+    # a CRM retry of a message we already accepted: ack it without touching MinIO or the stream
+    keys, states = await claim_messages([(channel, data)])
+    if states[0] == dedupe.DONE:
+        return {"ok": True, "queued": False, "duplicate": True, "room_id": room_id}
+    if states[0] == dedupe.PENDING:
+        # the first delivery may still fail, only ack once it is queued
+        raise HTTPException(
+            status_code=409,
+            detail="message is being processed, retry later",
+            headers={"Retry-After": DEDUPE_RETRY_AFTER},
+        )
+
+    ts = datetime.datetime.utcnow().isoformat()
+    key_json = f"raw/{channel}/{room_id}/{ts}.json"
+    write_behind = ARCHIVE_MODE == "write_behind"
+
+    try:
+        if not write_behind:
+            await archive_before_ack(key_json, raw_bytes, channel)
+
+        entry = stream_entry(channel, room_id, key_json, ts, raw_bytes, write_behind)
+
+        try:
+            client, stream = stream_target(shard_for(room_id))
+            with timed("webhook_stage_seconds", stage="xadd"):
+                await client.xadd(stream, entry)
+            metrics["redis_messages_total"].inc()
+        except Exception as e:
+            log_event("redis_xadd_error", error=str(e))
+            raise HTTPException(status_code=500, detail="Redis push error")
+    except HTTPException:
+        # not accepted after all: the CRM's retry must go through
+        await dedupe.release(app.state.redis, keys)
+        raise
+    await accept_messages(keys)
+
+    if write_behind:
+        await archive_behind(key_json, raw_bytes, channel)
 
     return {"ok": True, "queued": True, "room_id": room_id}
 
+def parse_batch_body(body, content_type):
+    """
+    Returns a list of (item, raw bytes, error). Accepts a JSON array, or
+    NDJSON (one object per line) where a bad line only fails that item.
+    NDJSON items keep their line bytes; array items have no bytes of their
+    own (None) and are serialized once for the segment.
+    """
+    stripped = body.lstrip()
+    if stripped.startswith(b"[") and "ndjson" not in content_type:
+        try:
+            items = fastjson.loads(body)
+        except Exception:
+            raise HTTPException(status_code=400, detail="invalid json")
+        return [(item, None, None) for item in items]
+
+    parsed = []
+    for line in body.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            parsed.append((fastjson.loads(line), line, None))
+        except Exception:
+            parsed.append((None, None, "invalid json"))
+    return parsed
+
+@app.post("/webhook/batch")
+async def webhook_batch(request: Request, response: Response):
+    """
+    Bulk ingest: JSON array or NDJSON body. The whole batch is archived as one
+    NDJSON segment object (each stream entry records its offset/length in it)
+    and pushed with one pipelined XADD. Returns a result per item, in order;
+    items another request is still queueing fail with retry: true and the
+    response carries Retry-After.
+    """
+    check_backpressure()
+
+    body = await request.body()
+    with timed("webhook_stage_seconds", stage="parse"):
+        parsed = parse_batch_body(body, request.headers.get("content-type", ""))
+    if len(parsed) > WEBHOOK_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"batch larger than {WEBHOOK_BATCH_MAX_ITEMS} items")
+
+    ts = datetime.datetime.utcnow().isoformat()
+    segment_key = f"raw/batch/{ts[:10]}/{ts}-{uuid.uuid4().hex[:8]}.ndjson"
+    write_behind = ARCHIVE_MODE == "write_behind"
+
+    results = [None] * len(parsed)
+    valid = []
+    for index, (data, raw_bytes, error) in enumerate(parsed):
+        if error is None and not isinstance(data, dict):
+            error = "item is not a json object"
+        if error:
+            results[index] = {"index": index, "ok": False, "error": error}
+            continue
+        valid.append((index, data, raw_bytes, extract_route(data)))
+
+    # one pipelined SET NX for the whole batch; a repeat within the batch is a duplicate too
+    keys, states = await claim_messages([(route[0], data) for _, data, _, route in valid])
+    claimed = [key for key, state in zip(keys, states) if state == dedupe.NEW]
+
+    entries = []
+    room_ids = []
+    segment = bytearray()
+    for (index, data, raw_bytes, (channel, room_id)), state in zip(valid, states):
+        if state == dedupe.DONE:
+            results[index] = {"index": index, "ok": True, "queued": False, "duplicate": True, "room_id": room_id}
+            continue
+        if state == dedupe.PENDING:
+            results[index] = {"index": index, "ok": False, "error": "message is being processed, retry later",
+                              "retry": True, "room_id": room_id}
+            response.headers["Retry-After"] = DEDUPE_RETRY_AFTER
+            continue
+        if raw_bytes is None:
+            raw_bytes = fastjson.dumpb(data)
+        entries.append(stream_entry(channel, room_id, segment_key, ts, raw_bytes, write_behind, offset=len(segment)))
+        room_ids.append(room_id)
+        segment += raw_bytes + b"\n"
+        results[index] = {"index": index, "ok": True, "queued": True, "room_id": room_id}
+
+    if not entries:
+        # ok when everything left was a duplicate
+        return {"ok": bool(valid) and dedupe.PENDING not in states, "queued": 0, "results": results}
+
+    segment = bytes(segment)
+    try:
+        if not write_behind:
+            await archive_before_ack(segment_key, segment, "batch")
+
+        try:
+            # one pipeline per Redis node; entries of a room keep their order within its shard
+            pipes = {}
+            for room_id, entry in zip(room_ids, entries):
+                client, stream = stream_target(shard_for(room_id))
+                pipe = pipes.get(id(client))
+                if pipe is None:
+                    pipe = pipes[id(client)] = client.pipeline(transaction=False)
+                pipe.xadd(stream, entry)
+            with timed("webhook_stage_seconds", stage="xadd"):
+                await asyncio.gather(*(pipe.execute() for pipe in pipes.values()))
+            metrics["redis_messages_total"].inc(len(entries))
+        except Exception as e:
+            log_event("redis_xadd_error", error=str(e), batch_size=len(entries))
+            raise HTTPException(status_code=500, detail="Redis push error")
+    except HTTPException:
+        await dedupe.release(app.state.redis, claimed)
+        raise
+    await accept_messages(claimed)
+
+    if write_behind:
+        await archive_behind(segment_key, segment, "batch")
+
+    return {"ok": True, "queued": len(entries), "results": results}
+
 @app.post("/sync-keywords")
 async def manual_sync_keywords(body: dict):
     """
@@ -90,36 +370,90 @@ async def manual_sync_keywords(body: dict):
         "transaction": ["bayar","lunas"]
     }
     """
-    redis = app.state.redis
-
-    for category in ["opening", "booking", "transaction"]:
-        kws = body.get(category, [])
-        if kws:
-            await redis.delete(f"keywords:{category}")
-            for k in kws:
-                await redis.sadd(f"keywords:{category}", k)
-
-    return {"ok": True, "counts": {c: len(body.get(c, [])) for c in ["opening","booking","transaction"]}}
-
-# @app.get("/funnel-report")
-# async def funnel_report(start: str = None, end: str = None):
-#     """
-#     Simple report aggregated from funnel table.
-#     """
-#     pool = app.state.db
-#     sql = "SELECT channel, COUNT(*) as leads_count, COUNT(booking_date) FILTER (WHERE booking_date IS NOT NULL) as bookings_count, SUM(transaction_value) as transaction_value_sum FROM funnel WHERE 1=1"
-#     params = []
-#     if start:
-#         sql += " AND leads_date >= $1"
-#         params.append(start)
-#     if end:
-#         if not params:
-#             sql += " AND leads_date <= $1"
-#             params.append(end)
-#         else:
-#             sql += " AND leads_date <= ${}".format(len(params)+1)
-#             params.append(end)
-#     sql += " GROUP BY channel"
-#     async with pool.acquire() as conn:
-#         rows = await conn.fetch(sql, *params) if params else await conn.fetch(sql)
-#     return [dict(r) for r in rows]
+    # categories left out (or empty) keep their current keywords
+    wanted = {c: body[c] for c in CATEGORIES if body.get(c)}
+    version, changed = await apply_keywords(app.state.redis, wanted)
+
+    return {
+        "ok": True,
+        "counts": {c: len(body.get(c, [])) for c in CATEGORIES},
+        "changed": changed,
+        "version": version,
+    }
+
+@app.get("/funnel-report")
+async def funnel_report(start: Optional[datetime.date] = None, end: Optional[datetime.date] = None):
+    """
+    Funnel aggregated per channel, read from the funnel_daily rollup.
+    Cached in-process until the TTL expires or the ETL bumps the rollup version.
+    """
+    version = await app.state.redis.get(ROLLUP_VERSION_KEY)
+    cache_key = (start, end)
+    cached = app.state.report_cache.get(cache_key, version)
+    if cached is not None:
+        return cached
+
+    sql = """
+        SELECT channel,
+               SUM(leads_count) AS leads_count,
+               SUM(bookings_count) AS bookings_count,
+               SUM(transactions_count) AS transactions_count,
+               SUM(transaction_value_sum) AS transaction_value_sum
+        FROM funnel_daily
+        WHERE ($1::date IS NULL OR leads_date >= $1)
+          AND ($2::date IS NULL OR leads_date <= $2)
+        GROUP BY channel
+        HAVING SUM(leads_count) > 0
+        ORDER BY channel
+    """
+    async with app.state.db.acquire() as conn:
+        rows = await conn.fetch(sql, start, end)
+    result = [dict(r) for r in rows]
+    app.state.report_cache.set(cache_key, version, result)
+    return result
+
+def token_matches(given, expected):
+    # constant-time, so the token can't be guessed byte by byte from response timing
+    return given is not None and hmac.compare_digest(given.encode(), expected.encode())
+
+@app.get("/export/funnel")
+async def export_funnel(request: Request, format: str = "csv", rejects: bool = False):
+    """
+    Streams the funnel table (or only rejected rows) as CSV or Parquet,
+    in constant memory.
+    """
+    if not EXPORT_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not token_matches(request.headers.get("x-export-token"), EXPORT_TOKEN):
+        raise HTTPException(status_code=401, detail="invalid export token")
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {list(FORMATS)}")
+    if not format_available(format):
+        raise HTTPException(status_code=501, detail=f"{format} export is not available on this server")
+
+    kind = "reject" if rejects else "report"
+    media_type = FORMATS[format][0]
+    return StreamingResponse(
+        stream_funnel(app.state.db, format, rejects_only=rejects, chunk_rows=EXPORT_CHUNK_ROWS),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{export_filename(kind, format)}"'},
+    )
+
+@app.post("/debug/profile")
+async def debug_profile(request: Request, seconds: float = 10):
+    """
+    Sample every thread of this API process for `seconds` and return the
+    stacks in folded format (flamegraph.pl / speedscope).
+    """
+    if not PROFILING_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not token_matches(request.headers.get("x-profiling-token"), PROFILING_TOKEN):
+        raise HTTPException(status_code=401, detail="invalid profiling token")
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be in (0, {PROFILE_MAX_SECONDS}]")
+    if profiling.profiler.running:
+        raise HTTPException(status_code=409, detail="a capture is already running")
+    folded = await profiling.capture(seconds)
+    return PlainTextResponse(folded, headers={
+        "Content-Disposition": f'attachment; filename="api-{os.getpid()}-{int(datetime.datetime.utcnow().timestamp())}.folded"'
+    })
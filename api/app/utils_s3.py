@@ -1,5 +1,8 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import boto3
 from botocore.client import Config
+from common.observability import log_event, timed
 
 def get_s3_client(endpoint, access_key, secret_key):
     session = boto3.session.Session()
@@ -16,3 +19,82 @@ def ensure_bucket(s3, bucket):
         s3.create_bucket(Bucket=bucket)
     except Exception:
         pass
+
+class S3Archiver:
+    """
+    Keeps boto3 off the event loop: uploads run on a bounded thread pool and
+    at most `max_inflight` of them may be pending at once (backpressure).
+
+    put() waits for the upload to finish. enqueue() returns right away and
+    lets background tasks drain a local write-behind buffer.
+    """
+
+    def __init__(self, s3, bucket, threads=16, max_inflight=64, buffer_size=10000, acquire_timeout=5.0, retries=3):
+        self.s3 = s3
+        self.bucket = bucket
+        self.threads = threads
+        self.acquire_timeout = acquire_timeout
+        self.retries = retries
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="s3") if threads > 0 else None
+        self.inflight = asyncio.Semaphore(max_inflight)
+        self.buffer = asyncio.Queue(maxsize=buffer_size)
+        self.tasks = []
+
+    def _put(self, key, body):
+        return self.s3.put_object(Bucket=self.bucket, Key=key, Body=body, ContentType="application/json")
+
+    async def put(self, key, body):
+        """
+        Raises asyncio.TimeoutError when uploads stay saturated for longer than acquire_timeout.
+        """
+        if self.executor is None:
+            # legacy behaviour: upload on the event loop thread
+            with timed("webhook_stage_seconds", stage="s3_put"):
+                return self._put(key, body)
+        await asyncio.wait_for(self.inflight.acquire(), self.acquire_timeout)
+        try:
+            loop = asyncio.get_running_loop()
+            with timed("webhook_stage_seconds", stage="s3_put"):
+                return await loop.run_in_executor(self.executor, self._put, key, body)
+        finally:
+            self.inflight.release()
+
+    def start(self):
+        for _ in range(max(self.threads, 1)):
+            self.tasks.append(asyncio.create_task(self._drain()))
+
+    def enqueue(self, key, body):
+        """
+        Returns False when the write-behind buffer is full.
+        """
+        try:
+            self.buffer.put_nowait((key, body))
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def _drain(self):
+        while True:
+            key, body = await self.buffer.get()
+            try:
+                for attempt in range(self.retries):
+                    try:
+                        await self.put(key, body)
+                        log_event("s3_upload_success", key=key, mode="write_behind")
+                        break
+                    except Exception as e:
+                        log_event("s3_upload_error", key=key, error=str(e), attempt=attempt + 1)
+                        await asyncio.sleep(0.5 * (attempt + 1))
+            finally:
+                self.buffer.task_done()
+
+    async def close(self, timeout=10.0):
+        if self.tasks:
+            try:
+                await asyncio.wait_for(self.buffer.join(), timeout)
+            except asyncio.TimeoutError:
+                log_event("s3_archive_dropped", pending=self.buffer.qsize())
+            for t in self.tasks:
+                t.cancel()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
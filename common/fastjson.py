@@ -0,0 +1,32 @@
+import json
+
+# orjson when installed (api/worker requirements), stdlib json otherwise
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data):
+    """bytes/str -> object. Falls back to json for what orjson rejects (e.g. NaN, >64-bit ints)."""
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+def dumpb(obj):
+    """object -> compact UTF-8 JSON bytes."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+def dumps(obj):
+    """object -> compact JSON str."""
+    return dumpb(obj).decode("utf-8")
@@ -0,0 +1,228 @@
+import re
+import datetime
+from decimal import Decimal
+
+# bumped whenever funnel/funnel_daily change, the API report cache keys on it
+ROLLUP_VERSION_KEY = "funnel:rollup:version"
+
+# etl_state rows of the funnel ETL: its incremental watermark and last full rebuild, suffixed
+# ":{partition}/{partitions}" per partition when ETL_PARTITIONS > 1 (etl/partitions.py)
+WATERMARK_NAME = "funnel"
+FULL_REBUILD_NAME = "funnel_full_rebuild"
+
+money_re = re.compile(r"(\d{1,3}(?:[.,]\d{3})*(?:[.,]\d{2})?)")
+date_re = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+FUNNEL_FIELDS = ("leads_date", "opening_keyword", "booking_date", "transaction_date", "transaction_value", "phone")
+
+
+def as_utc(value):
+    # naive timestamps are stored (and read back) as UTC by asyncpg
+    if value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value.astimezone(datetime.timezone.utc)
+
+
+def to_date(value):
+    # funnel dates are UTC dates, whatever offset the payload timestamp carried
+    return as_utc(value).date() if isinstance(value, datetime.datetime) else value
+
+
+class FunnelState:
+    """
+    Funnel fields of one room, folded one message at a time (oldest first).
+    The ETL folds a room's whole history from an empty state; the worker's
+    streaming mode folds new messages onto the stored funnel row.
+    """
+
+    __slots__ = FUNNEL_FIELDS
+
+    def __init__(self, leads_date=None, opening_keyword=None, booking_date=None,
+                 transaction_date=None, transaction_value=None, phone=None):
+        self.leads_date = leads_date
+        self.opening_keyword = opening_keyword
+        self.booking_date = booking_date
+        self.transaction_date = transaction_date
+        self.transaction_value = transaction_value
+        self.phone = phone
+
+    def apply(self, m, matcher):
+        text = (m.get("content") or "").lower()
+        created = m.get("created_at")
+
+        self.phone = self.phone or m.get("phone")
+        raw = m.get("raw_payload")
+        if isinstance(raw, dict):
+            self.phone = self.phone or raw.get("sender", {}).get("phone") or raw.get("phone")
+
+        opening_kw, is_booking, is_transaction = matcher.match(text)
+
+        if not self.leads_date and opening_kw:
+            self.leads_date = to_date(created)
+            self.opening_keyword = opening_kw
+        if not self.leads_date and isinstance(raw, dict):
+            sender_type = raw.get("sender", {}).get("type") or raw.get("sender_type")
+            if sender_type and sender_type.lower() == "customer":
+                self.leads_date = to_date(created)
+
+        if is_booking:
+            match = date_re.search(text)
+            if match:
+                try:
+                    self.booking_date = datetime.datetime.strptime(match.group(), "%Y-%m-%d").date()
+                except ValueError:
+                    pass
+
+        if is_transaction:
+            self.transaction_date = to_date(created)
+            match = money_re.search(text)
+            if match:
+                # clean format 1.500.000 -> 1500000
+                self.transaction_value = float(match.group().replace(".", "").replace(",", ""))
+
+    def as_tuple(self):
+        return (self.leads_date, self.opening_keyword, self.booking_date,
+                self.transaction_date, self.transaction_value, self.phone)
+
+
+def classify_room(msgs, matcher):
+    """
+    Walk one room's messages (oldest first) and derive its funnel fields.
+    Returns (leads_date, opening_keyword, booking_date, transaction_date, transaction_value, phone).
+    """
+    state = FunnelState()
+    for m in msgs:
+        state.apply(m, matcher)
+    return state.as_tuple()
+
+
+FUNNEL_UPSERT = """
+    INSERT INTO funnel (room_id, leads_date, channel, phone, booking_date, transaction_date, transaction_value, opening_keyword, created_at)
+    SELECT * FROM unnest($1::bigint[], $2::date[], $3::text[], $4::text[], $5::date[], $6::date[], $7::numeric[], $8::text[], $9::timestamptz[])
+    ON CONFLICT (room_id) DO UPDATE SET
+        leads_date = EXCLUDED.leads_date,
+        channel = EXCLUDED.channel,
+        phone = EXCLUDED.phone,
+        booking_date = EXCLUDED.booking_date,
+        transaction_date = EXCLUDED.transaction_date,
+        transaction_value = EXCLUDED.transaction_value,
+        opening_keyword = EXCLUDED.opening_keyword
+"""
+
+
+async def request_full_rebuild(conn):
+    """Drop every funnel watermark (single and per partition): the next ETL cycle rebuilds funnel and funnel_daily."""
+    await conn.execute("DELETE FROM etl_state WHERE name = $1 OR name LIKE $1 || ':%'", WATERMARK_NAME)
+
+
+async def upsert_funnel_rows(conn, rows):
+    """
+    One round trip for the whole batch: rows are shipped as parallel arrays and unnested server side.
+    """
+    if not rows:
+        return
+    columns = list(zip(*rows))
+    await conn.execute(FUNNEL_UPSERT, *[list(c) for c in columns])
+
+
+async def apply_rollup(conn, room_ids, sign):
+    """
+    Add (sign=1) or remove (sign=-1) the current funnel rows of room_ids
+    from the funnel_daily rollup.
+    """
+    await conn.execute("""
+    INSERT INTO funnel_daily AS d (leads_date, channel, leads_count, bookings_count, transactions_count, transaction_value_sum)
+    SELECT leads_date, channel,
+           $2 * COUNT(*),
+           $2 * COUNT(booking_date),
+           $2 * COUNT(transaction_date),
+           $2 * COALESCE(SUM(transaction_value), 0)
+    FROM funnel
+    WHERE room_id = ANY($1::bigint[])
+    GROUP BY leads_date, channel
+    ORDER BY leads_date, channel
+    ON CONFLICT (leads_date, channel) DO UPDATE SET
+        leads_count = d.leads_count + EXCLUDED.leads_count,
+        bookings_count = d.bookings_count + EXCLUDED.bookings_count,
+        transactions_count = d.transactions_count + EXCLUDED.transactions_count,
+        transaction_value_sum = d.transaction_value_sum + EXCLUDED.transaction_value_sum;
+    """, room_ids, sign)
+
+
+async def write_funnel_rows(conn, rows):
+    """
+    Upsert funnel rows and keep funnel_daily in step. Callers must hold the
+    rooms row locks of these rooms for the transaction, so the worker and
+    the ETL never interleave on one room.
+    """
+    room_ids = [row[0] for row in rows]
+    await apply_rollup(conn, room_ids, -1)
+    await upsert_funnel_rows(conn, rows)
+    await apply_rollup(conn, room_ids, 1)
+
+
+def add_rollup(delta, leads_date, channel, booking_date, transaction_date, transaction_value, sign):
+    counts = delta.setdefault((leads_date, channel), [0, 0, 0, Decimal(0)])
+    counts[0] += sign
+    counts[1] += sign if booking_date is not None else 0
+    counts[2] += sign if transaction_date is not None else 0
+    if transaction_value is not None:
+        counts[3] += sign * Decimal(str(transaction_value))
+
+
+async def apply_rollup_delta(conn, delta):
+    """
+    funnel_daily += delta in one statement, rows locked in key order. Used by
+    the streaming path: the (today, channel) rows are hot across workers, so
+    they are touched once, at the end of the transaction.
+    """
+    keys = sorted((k for k, v in delta.items() if any(v)), key=lambda k: (k[0] is None, k[0] or datetime.date.min, k[1] or ""))
+    if not keys:
+        return
+    await conn.execute("""
+    INSERT INTO funnel_daily AS d (leads_date, channel, leads_count, bookings_count, transactions_count, transaction_value_sum)
+    SELECT * FROM unnest($1::date[], $2::text[], $3::bigint[], $4::bigint[], $5::bigint[], $6::numeric[])
+    ON CONFLICT (leads_date, channel) DO UPDATE SET
+        leads_count = d.leads_count + EXCLUDED.leads_count,
+        bookings_count = d.bookings_count + EXCLUDED.bookings_count,
+        transactions_count = d.transactions_count + EXCLUDED.transactions_count,
+        transaction_value_sum = d.transaction_value_sum + EXCLUDED.transaction_value_sum;
+    """, [k[0] for k in keys], [k[1] for k in keys],
+        *[[delta[k][i] for k in keys] for i in range(4)])
+
+
+async def advance_funnel(conn, room_messages, channels, matcher):
+    """
+    Streaming update: fold new messages ({room db id: [message, ...]}) onto
+    the stored funnel rows, O(new messages) instead of O(room history).
+    Messages older than ones already folded are applied late; the ETL
+    reconciliation pass fixes those rooms. Callers hold the rooms row locks.
+    """
+    room_ids = sorted(room_messages)
+    stored = {
+        r["room_id"]: r
+        for r in await conn.fetch(f"""
+            SELECT room_id, channel, {', '.join(FUNNEL_FIELDS)} FROM funnel WHERE room_id = ANY($1::bigint[])
+        """, room_ids)
+    }
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    rows = []
+    delta = {}
+    for room_id in room_ids:
+        old = stored.get(room_id)
+        if old is not None:
+            state = FunnelState(*(old[f] for f in FUNNEL_FIELDS))
+            add_rollup(delta, old["leads_date"], old["channel"], old["booking_date"],
+                       old["transaction_date"], old["transaction_value"], -1)
+        else:
+            state = FunnelState()
+        for m in sorted(room_messages[room_id], key=lambda m: as_utc(m["created_at"])):
+            state.apply(m, matcher)
+        leads_date, opening_keyword, booking_date, transaction_date, transaction_value, phone = state.as_tuple()
+        add_rollup(delta, leads_date, channels[room_id], booking_date, transaction_date, transaction_value, 1)
+        rows.append((room_id, leads_date, channels[room_id], phone, booking_date,
+                     transaction_date, transaction_value, opening_keyword, now))
+    await upsert_funnel_rows(conn, rows)
+    await apply_rollup_delta(conn, delta)
+    return len(rows)
@@ -0,0 +1,115 @@
+import re
+import logging
+from common.keywords import CATEGORIES, KEYWORDS_VERSION_KEY
+
+# used when keyword sync has not populated the redis sets yet
+BOOKING_KEYWORDS = ["booking", "book", "daftar", "reserve", "registrasi", "registr"]
+TRANSACTION_KEYWORDS = ["paid", "transfer", "bayar", "pembayaran", "lunas", "sudah transfer"]
+
+_END = None  # trie marker: categories of the keyword ending at this node
+
+
+def _trie_regex(node):
+    children = sorted(((ch, child) for ch, child in node.items() if ch is not _END), key=lambda item: item[0])
+    alts = [re.escape(ch) + _trie_regex(child) for ch, child in children]
+    if not alts:
+        return ""
+    body = alts[0] if len(alts) == 1 else "(?:%s)" % "|".join(alts)
+    if _END in node:
+        body = "(?:%s)?" % body
+    return body
+
+
+class KeywordMatcher:
+    """
+    All keyword categories compiled into one regex so a message is scanned
+    once instead of once per keyword.
+
+    The regex is a prefix trie wrapped in a lookahead, so every position
+    yields the longest keyword starting there. Any shorter keyword starting
+    at the same position is a prefix of that one, so each keyword is
+    precomputed to carry the categories of all its prefixes.
+    """
+
+    def __init__(self, opening, booking, transaction, version=None):
+        self.version = version
+        self.keywords = (tuple(opening), tuple(booking), tuple(transaction))
+
+        trie = {}
+        for category, kws in zip(CATEGORIES, self.keywords):
+            for kw in kws:
+                kw = (kw or "").lower()
+                if not kw:
+                    continue
+                node = trie
+                for ch in kw:
+                    node = node.setdefault(ch, {})
+                node.setdefault(_END, set()).add(category)
+
+        # matched keyword -> (opening keyword, is booking, is transaction)
+        self.hits = {}
+        self._collect(trie, "", None, frozenset())
+        self.pattern = re.compile("(?=(%s))" % _trie_regex(trie)) if self.hits else None
+
+    def _collect(self, node, prefix, opening, categories):
+        if _END in node:
+            categories = categories | node[_END]
+            if "opening" in node[_END]:
+                opening = prefix
+            self.hits[prefix] = (opening, "booking" in categories, "transaction" in categories)
+        for ch, child in node.items():
+            if ch is not _END:
+                self._collect(child, prefix + ch, opening, categories)
+
+    def match(self, text):
+        """
+        Returns (opening_keyword, has_booking, has_transaction) for a lowercased text.
+        opening_keyword is the leftmost (then longest) opening keyword found.
+        """
+        opening_keyword = None
+        booking = transaction = False
+        if self.pattern is None:
+            return opening_keyword, booking, transaction
+
+        for m in self.pattern.finditer(text):
+            opening, is_booking, is_transaction = self.hits[m.group(1)]
+            if opening_keyword is None:
+                opening_keyword = opening
+            booking = booking or is_booking
+            transaction = transaction or is_transaction
+            if opening_keyword and booking and transaction:
+                break
+        return opening_keyword, booking, transaction
+
+
+async def load_keywords(redis):
+    opening_kwset = await redis.smembers("keywords:opening")
+    booking_kwset = await redis.smembers("keywords:booking")
+    transaction_kwset = await redis.smembers("keywords:transaction")
+
+    opening_kws = [k.decode().lower() for k in opening_kwset] if opening_kwset else []
+    booking_kws = [k.decode().lower() for k in booking_kwset] if booking_kwset else BOOKING_KEYWORDS
+    transaction_kws = [k.decode().lower() for k in transaction_kwset] if transaction_kwset else TRANSACTION_KEYWORDS
+    return opening_kws, booking_kws, transaction_kws
+
+
+_matcher = None
+
+
+async def get_keyword_matcher(redis):
+    """
+    Compiled matcher cached per process. Rebuilt only when the version
+    published by keyword sync moves (or, without a version key, when the
+    keyword sets themselves change).
+    """
+    global _matcher
+    version = await redis.get(KEYWORDS_VERSION_KEY)
+    if _matcher is not None and version is not None and _matcher.version == version:
+        return _matcher
+
+    keywords = await load_keywords(redis)
+    if _matcher is None or _matcher.keywords != tuple(tuple(k) for k in keywords):
+        _matcher = KeywordMatcher(*keywords, version=version)
+        logging.info(f"keyword matcher compiled version={version} sizes={[len(k) for k in keywords]}")
+    _matcher.version = version
+    return _matcher
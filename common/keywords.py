@@ -0,0 +1,64 @@
+"""
+Keyword sets in Redis (keywords:<category>), written by keyword-sync and the
+API's /sync-keywords, read by the compiled matcher (keyword_matcher.py).
+"""
+import json, hashlib
+from redis.exceptions import WatchError
+
+CATEGORIES = ("opening", "booking", "transaction")
+# bumped on every change so consumers can cache compiled matchers
+KEYWORDS_VERSION_KEY = "keywords:version"
+# category -> sha256 of its keyword set, lets an unchanged sync skip all writes
+KEYWORDS_HASHES_KEY = "keywords:hashes"
+# pub/sub channel, message is the new keywords:version
+KEYWORDS_CHANNEL = "keywords:changed"
+
+
+def keywords_hash(kws):
+    return hashlib.sha256(json.dumps(sorted(kws)).encode("utf-8")).hexdigest()
+
+
+async def apply_keywords(redis, keywords_by_category):
+    """
+    Make keywords:<category> match the given lists, atomically.
+
+    Categories whose content hash is unchanged are not touched. For the rest
+    only the diff (SREM/SADD) is applied, in one MULTI under WATCH, so readers
+    never see an empty or half-written set. Bumps keywords:version and
+    publishes it on keywords:changed. Returns (version, changed categories);
+    version is None when nothing changed.
+    """
+    wanted = {c: set(kws) for c, kws in keywords_by_category.items()}
+    hashes = {c: keywords_hash(kws) for c, kws in wanted.items()}
+    stored = await redis.hmget(KEYWORDS_HASHES_KEY, list(hashes))
+    changed = [c for c, old in zip(hashes, stored) if (old.decode() if old else None) != hashes[c]]
+    if not changed:
+        return None, []
+
+    keys = {c: f"keywords:{c}" for c in changed}
+    async with redis.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                await pipe.watch(*keys.values())
+                current = {}
+                for c, key in keys.items():
+                    current[c] = {m.decode() for m in await pipe.smembers(key)}
+                pipe.multi()
+                for c, key in keys.items():
+                    to_remove = current[c] - wanted[c]
+                    to_add = wanted[c] - current[c]
+                    if to_remove:
+                        pipe.srem(key, *to_remove)
+                    if to_add:
+                        pipe.sadd(key, *to_add)
+                pipe.hset(KEYWORDS_HASHES_KEY, mapping={c: hashes[c] for c in changed})
+                pipe.incr(KEYWORDS_VERSION_KEY)
+                results = await pipe.execute()
+                break
+            except WatchError:
+                # another sync raced us, recompute the diff
+                continue
+
+    version = results[-1]
+    await redis.publish(KEYWORDS_CHANNEL, version)
+    return version, changed
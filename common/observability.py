@@ -0,0 +1,292 @@
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from contextlib import contextmanager
+from common import fastjson
+import atexit
+import logging
+import json
+import os
+import queue
+import random
+import sys
+import time
+import threading
+
+# shared by api, worker and funnel-etl: each service only feeds the metrics of its own stages
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+END_TO_END_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+ROOMS_BUCKETS = (0, 1, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000)
+
+metrics = {
+    "redis_messages_total": Counter(
+        "redis_messages_total", "Total messages pushed to Redis stream"
+    ),
+    "redis_messages_ack": Counter(
+        "redis_messages_ack", "Total messages acknowledged (ACK) by worker"
+    ),
+    "redis_messages_pending": Gauge(
+        "redis_messages_pending", "Total messages still pending / not ACK"
+    ),
+    "redis_stream_length": Gauge(
+        "redis_stream_length", "Entries currently in the Redis stream"
+    ),
+    "redis_group_lag": Gauge(
+        "redis_group_lag", "Stream entries not yet delivered to the consumer group"
+    ),
+    "redis_stream_shard_lag": Gauge(
+        "redis_stream_shard_lag", "Consumer group lag per stream shard", ["stream"]
+    ),
+    "worker_shards_owned": Gauge(
+        "worker_shards_owned", "Stream shards this worker process currently reads"
+    ),
+    "redis_messages_reclaimed": Counter(
+        "redis_messages_reclaimed", "Pending messages XAUTOCLAIMed from idle consumers"
+    ),
+    "webhook_rejected_backpressure": Counter(
+        "webhook_rejected_backpressure", "Webhook requests rejected because stream lag passed the threshold"
+    ),
+    "webhook_duplicates_suppressed": Counter(
+        "webhook_duplicates_suppressed", "Webhook messages answered as duplicates (CRM retries) without archiving or queueing"
+    ),
+    "webhook_duplicates_in_flight": Counter(
+        "webhook_duplicates_in_flight", "Webhook retries answered with 409 + Retry-After while the first delivery was still being queued"
+    ),
+    "worker_inflight_messages": Gauge(
+        "worker_inflight_messages", "Messages read from the stream but not yet ACKed"
+    ),
+    "worker_lane_queue_depth": Gauge(
+        "worker_lane_queue_depth", "Messages queued per worker lane", ["lane"]
+    ),
+    "worker_lane_busy": Gauge(
+        "worker_lane_busy", "1 while a worker lane is processing a batch", ["lane"]
+    ),
+    "worker_lane_busy_seconds": Counter(
+        "worker_lane_busy_seconds", "Time each worker lane spent processing (rate = utilisation)", ["lane"]
+    ),
+    "worker_funnel_rooms_updated": Counter(
+        "worker_funnel_rooms_updated", "Funnel rows updated by the worker in streaming mode"
+    ),
+    "worker_room_cache_lookups": Counter(
+        "worker_room_cache_lookups", "room_id -> rooms.id lookups in the worker cache", ["result"]
+    ),
+    "worker_room_cache_size": Gauge(
+        "worker_room_cache_size", "Rooms held in the worker room cache"
+    ),
+    "worker_activity_flush_rooms": Histogram(
+        "worker_activity_flush_rooms", "Rooms per coalesced last_activity_at flush", buckets=ROOMS_BUCKETS
+    ),
+    "db_pool_connections": Gauge(
+        "db_pool_connections", "Postgres pool connections by state (in_use, idle)", ["pool", "state"]
+    ),
+    "db_pool_max_size": Gauge(
+        "db_pool_max_size", "Postgres pool max size (in_use / max = saturation)", ["pool"]
+    ),
+    "resource_up": Gauge(
+        "resource_up", "1 while the last health check of a Postgres pool / Redis client succeeded", ["resource"]
+    ),
+    "resource_ping_seconds": Histogram(
+        "resource_ping_seconds", "Health check round trip (SELECT 1 / PING)", ["resource"], buckets=LATENCY_BUCKETS
+    ),
+    "event_loop_lag_seconds": Histogram(
+        "event_loop_lag_seconds", "How late the event loop heartbeat woke up (LOOP_LAG_THRESHOLD_MS > 0)", buckets=LATENCY_BUCKETS
+    ),
+    "event_loop_blocked": Counter(
+        "event_loop_blocked", "Times a callback blocked the event loop longer than LOOP_LAG_THRESHOLD_MS"
+    ),
+    "log_events_suppressed": Counter(
+        "log_events_suppressed", "log_event lines not written (sampled, rate_limited, queue_full, unserializable)", ["event", "reason"]
+    ),
+    # per-stage latency
+    "webhook_stage_seconds": Histogram(
+        "webhook_stage_seconds", "Webhook time per stage (parse, dedupe, s3_put, xadd)", ["stage"], buckets=LATENCY_BUCKETS
+    ),
+    "worker_stage_seconds": Histogram(
+        "worker_stage_seconds", "Worker time per stage (s3_get, room_upsert, message_insert, funnel_update, activity_flush)", ["stage"], buckets=LATENCY_BUCKETS
+    ),
+    "worker_end_to_end_seconds": Histogram(
+        "worker_end_to_end_seconds", "Time from webhook received_at to worker ACK", buckets=END_TO_END_BUCKETS
+    ),
+    "etl_cycle_seconds": Histogram(
+        "etl_cycle_seconds", "Funnel ETL cycle duration", ["mode"], buckets=END_TO_END_BUCKETS
+    ),
+    "etl_rooms_per_cycle": Histogram(
+        "etl_rooms_per_cycle", "Rooms recomputed per funnel ETL cycle", ["mode"], buckets=ROOMS_BUCKETS
+    ),
+    "etl_partitions_claimed": Gauge(
+        "etl_partitions_claimed", "Room partitions this ETL process processed in its last cycle"
+    ),
+    "etl_partition_rooms": Counter(
+        "etl_partition_rooms", "Rooms recomputed by the funnel ETL per room partition", ["partition"]
+    ),
+    "etl_partition_last_run_timestamp": Gauge(
+        "etl_partition_last_run_timestamp", "Unix time a room partition was last processed", ["partition"]
+    ),
+    "etl_partition_watermark_lag_seconds": Gauge(
+        "etl_partition_watermark_lag_seconds", "Age of a room partition's incremental watermark", ["partition"]
+    ),
+    "etl_classification_seconds": Histogram(
+        "etl_classification_seconds", "Time spent classifying messages per ETL batch", buckets=LATENCY_BUCKETS
+    ),
+}
+
+def parse_event_map(value):
+    """ "message_ack=0.01,s3_upload_success=0.1" -> {"message_ack": 0.01, ...} """
+    out = {}
+    for part in value.split(","):
+        if "=" in part:
+            name, number = part.split("=", 1)
+            out[name.strip()] = float(number)
+    return out
+
+# log_event lines go through a bounded queue to a writer thread (LOG_ASYNC=0 writes inline)
+LOG_ASYNC = os.getenv("LOG_ASYNC", "1") == "1"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_BATCH_MAX = int(os.getenv("LOG_BATCH_MAX", "500"))
+# fraction of lines kept per event; per-message events are sampled by default, the rest keep 1
+LOG_SAMPLE_RATES = parse_event_map(os.getenv("LOG_SAMPLE_RATES", "message_ack=0.01,s3_upload_success=0.01"))
+# max lines per second per event, "*" applies to every event without its own entry (empty = no limit)
+LOG_RATE_LIMITS = parse_event_map(os.getenv("LOG_RATE_LIMITS", ""))
+
+# level still gates log_event (e.g. setLevel(WARNING) silences it); lines are written by LogWriter
+logger = logging.getLogger("app_logger")
+logger.setLevel(logging.INFO)
+
+def make_serializable(obj):
+    if isinstance(obj, bytes):
+        return obj.decode("utf-8")
+    elif isinstance(obj, dict):
+        return {k: make_serializable(v) for k,v in obj.items()}
+    elif isinstance(obj, list):
+        return [make_serializable(v) for v in obj]
+    else:
+        return obj
+
+def format_line(event, kwargs):
+    log_data = {
+        "event": event,
+        "fields": make_serializable(kwargs)
+    }
+    try:
+        return fastjson.dumpb(log_data) + b"\n"
+    except Exception:
+        return json.dumps(log_data, default=str).encode("utf-8") + b"\n"
+
+def write_stdout(data):
+    stream = getattr(sys.stdout, "buffer", None)
+    if stream is not None:
+        stream.write(data)
+    else:
+        sys.stdout.write(data.decode("utf-8"))
+    sys.stdout.flush()
+
+
+class LogWriter:
+    """
+    Serializes and writes log_event lines on a background thread, in batches
+    of up to LOG_BATCH_MAX newline-delimited lines per write. The caller only
+    does a put_nowait: when the queue is full (stdout or promtail too slow)
+    the line is dropped and counted instead of blocking the event loop.
+    """
+
+    def __init__(self, queue_size, batch_max):
+        self.pid = os.getpid()
+        self.queue = queue.Queue(queue_size)
+        self.batch_max = batch_max
+        self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def submit(self, event, kwargs):
+        try:
+            self.queue.put_nowait((event, kwargs))
+        except queue.Full:
+            count_suppressed(event, "queue_full")
+
+    def run(self):
+        closing = False
+        while not closing:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_max:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for item in batch:
+                if item is None:
+                    closing = True
+                    continue
+                try:
+                    lines.append(format_line(*item))
+                except Exception:
+                    count_suppressed(item[0], "unserializable")
+            if lines:
+                try:
+                    write_stdout(b"".join(lines))
+                except Exception:
+                    pass
+
+    def close(self, timeout=2):
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.thread.join(timeout)
+
+
+log_writer = None
+rate_windows = {}
+suppressed_counters = {}
+
+def count_suppressed(event, reason):
+    counter = suppressed_counters.get((event, reason))
+    if counter is None:
+        counter = suppressed_counters[(event, reason)] = metrics["log_events_suppressed"].labels(event=event, reason=reason)
+    counter.inc()
+
+def allowed(event):
+    rate = LOG_SAMPLE_RATES.get(event)
+    if rate is not None and rate < 1 and random.random() >= rate:
+        count_suppressed(event, "sampled")
+        return False
+    limit = LOG_RATE_LIMITS.get(event, LOG_RATE_LIMITS.get("*"))
+    if limit:
+        second = int(time.monotonic())
+        window = rate_windows.get(event)
+        if window is None or window[0] != second:
+            window = rate_windows[event] = [second, 0]
+        window[1] += 1
+        if window[1] > limit:
+            count_suppressed(event, "rate_limited")
+            return False
+    return True
+
+def log_event(event: str, **kwargs):
+    global log_writer
+    if not logger.isEnabledFor(logging.INFO) or not allowed(event):
+        return
+    if not LOG_ASYNC:
+        write_stdout(format_line(event, kwargs))
+        return
+    # per process: a forked child (WORKER_PROCESSES) does not inherit the parent's thread
+    if log_writer is None or log_writer.pid != os.getpid():
+        log_writer = LogWriter(LOG_QUEUE_SIZE, LOG_BATCH_MAX)
+    log_writer.submit(event, kwargs)
+
+
+@contextmanager
+def timed(name, **labels):
+    """
+    Observe the duration of the block on histogram metrics[name].
+    """
+    histogram = metrics[name].labels(**labels) if labels else metrics[name]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start)
+
+
+def start_metrics_server(port: int = 9000):
+    thread = threading.Thread(target=start_http_server, args=(port,), daemon=True)
+    thread.start()
+    log_event("metrics_server_started", port=port)
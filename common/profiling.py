@@ -0,0 +1,178 @@
+"""
+Opt-in profiling for api, worker and funnel-etl. Nothing runs unless enabled:
+
+- Sampling profiler: a thread that samples every thread's Python stack each
+  PROFILE_SAMPLE_MS and aggregates them as folded stacks ("a;b;c 42" per
+  line), readable by flamegraph.pl, speedscope or inferno. Captured on
+  demand: SIGUSR1 starts / a second SIGUSR1 stops and writes
+  PROFILE_DIR/{service}-{pid}-{time}.folded (PROFILING=1), or the API's
+  POST /debug/profile.
+- Event-loop lag monitor (LOOP_LAG_THRESHOLD_MS > 0): a heartbeat task
+  measures loop lag, and a watchdog thread logs the loop thread's stack
+  while a callback blocks it longer than the threshold (e.g. a synchronous
+  boto3 call or a long classification loop).
+"""
+import os
+import sys
+import time
+import signal
+import asyncio
+import threading
+from collections import Counter
+from common.observability import log_event, metrics
+
+# install the SIGUSR1 capture toggle
+PROFILING = os.getenv("PROFILING", "0") == "1"
+PROFILE_SAMPLE_MS = float(os.getenv("PROFILE_SAMPLE_MS", "5"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/profiles")
+# 0 = no lag monitor
+LOOP_LAG_THRESHOLD_MS = float(os.getenv("LOOP_LAG_THRESHOLD_MS", "0"))
+LOOP_LAG_INTERVAL_MS = float(os.getenv("LOOP_LAG_INTERVAL_MS", "100"))
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def stack_of(frame):
+    """Outermost call first."""
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+
+class SamplingProfiler:
+    """Samples all threads' stacks on a background thread between start() and stop()."""
+
+    def __init__(self, interval_ms=PROFILE_SAMPLE_MS):
+        self.interval = interval_ms / 1000
+        self.counts = Counter()
+        self.samples = 0
+        self.thread = None
+        self.stopping = threading.Event()
+        self.started_at = None
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        if self.running:
+            raise RuntimeError("a capture is already running")
+        self.counts = Counter()
+        self.samples = 0
+        self.stopping.clear()
+        self.started_at = time.time()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                # thread name as the root frame: event loop vs S3 upload threads vs log writer
+                self.counts[";".join([names.get(ident, str(ident)), *stack_of(frame)])] += 1
+            self.samples += 1
+
+    def stop(self):
+        """Stop sampling, return the folded stacks."""
+        if not self.running:
+            return ""
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+        return "".join(f"{stack} {count}\n" for stack, count in self.counts.most_common())
+
+
+profiler = SamplingProfiler()
+
+
+async def capture(seconds):
+    """Profile the running process for `seconds`; returns folded stacks."""
+    profiler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        folded = profiler.stop()
+    log_event("profile_captured", seconds=seconds, samples=profiler.samples, stacks=len(profiler.counts))
+    return folded
+
+
+def toggle_capture(service):
+    """SIGUSR1: start a capture, or stop the running one and write it to PROFILE_DIR."""
+    if not profiler.running:
+        profiler.start()
+        log_event("profile_started", service=service, pid=os.getpid())
+        return
+    folded = profiler.stop()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{service}-{os.getpid()}-{int(time.time())}.folded")
+    with open(path, "w") as f:
+        f.write(folded)
+    log_event("profile_written", service=service, path=path, samples=profiler.samples)
+
+
+class LoopLagMonitor:
+    """
+    Heartbeat on the event loop every `interval`; the lag (how late it
+    wakes up) goes to event_loop_lag_seconds. The watchdog thread notices a
+    heartbeat overdue by more than `threshold` while the loop is still
+    blocked and logs what the loop thread is running right then.
+    """
+
+    def __init__(self, service, threshold_ms, interval_ms=LOOP_LAG_INTERVAL_MS):
+        self.service = service
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self.beat = time.monotonic()
+        self.reported = None
+        self.loop_thread = None
+
+    async def run(self):
+        self.loop_thread = threading.get_ident()
+        threading.Thread(target=self.watch, name="loop-watchdog", daemon=True).start()
+        while True:
+            self.beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - self.beat - self.interval
+            metrics["event_loop_lag_seconds"].observe(max(lag, 0))
+
+    def watch(self):
+        while True:
+            time.sleep(self.threshold / 2)
+            beat = self.beat
+            overdue = time.monotonic() - beat - self.interval
+            if overdue < self.threshold or self.reported == beat:
+                continue
+            # one report per blocking episode
+            self.reported = beat
+            frame = sys._current_frames().get(self.loop_thread)
+            metrics["event_loop_blocked"].inc()
+            log_event("event_loop_blocked", service=self.service, blocked_ms=round(overdue * 1000),
+                      stack=stack_of(frame) if frame is not None else [])
+
+
+def install(service):
+    """
+    Called once the service's event loop runs (api startup, worker
+    consumer(), etl main_loop). A no-op unless PROFILING or
+    LOOP_LAG_THRESHOLD_MS is set.
+    """
+    loop = asyncio.get_running_loop()
+    if PROFILING:
+        try:
+            loop.add_signal_handler(signal.SIGUSR1, toggle_capture, service)
+        except (NotImplementedError, RuntimeError, ValueError) as e:
+            # not the main thread / not supported on this platform
+            log_event("profiling_signal_error", service=service, error=str(e))
+    if LOOP_LAG_THRESHOLD_MS > 0:
+        monitor = LoopLagMonitor(service, LOOP_LAG_THRESHOLD_MS)
+        return loop.create_task(monitor.run())
+    return None
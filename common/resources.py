@@ -0,0 +1,116 @@
+"""
+Process-lifetime Postgres pools and Redis clients shared by api, worker and
+funnel-etl.
+
+    pool = await get_db_pool("worker", default_max=10)
+    redis = get_redis(REDIS_URL)
+
+Pools and clients are created on first use and kept until close_all(), so
+no request or cycle pays for connection setup. asyncpg keeps a prepared
+statement cache per connection, keyed by SQL text and sized by
+DB_STATEMENT_CACHE_SIZE: a hot query is parsed/planned on its first use on
+each pooled connection and reused after that.
+"""
+import os
+import time
+import asyncio
+import asyncpg
+import redis.asyncio as redis_lib
+from common.observability import log_event, metrics
+
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+# 0 = the service's own default (api 10, worker WORKER_LANES + 2, etl ETL_POOL_SIZE)
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "0"))
+# idle pooled connections are closed after this many seconds (0 = never)
+DB_POOL_MAX_INACTIVE_SECONDS = float(os.getenv("DB_POOL_MAX_INACTIVE_SECONDS", "300"))
+# asyncpg's per-connection prepared statement cache; keep it above the number of hot statements
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "1024"))
+# connections per Redis URL; callers wait up to REDIS_POOL_TIMEOUT seconds for a free one
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "64"))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "5"))
+RESOURCE_HEALTH_SECONDS = float(os.getenv("RESOURCE_HEALTH_SECONDS", "10"))
+
+pools = {}
+redis_clients = {}
+
+
+async def get_db_pool(name, default_max=10, url=None):
+    """The process's pool for `name`, created on first call."""
+    pool = pools.get(name)
+    if pool is None:
+        max_size = DB_POOL_MAX_SIZE or default_max
+        pool = await asyncpg.create_pool(
+            url or os.getenv("DATABASE_URL"),
+            min_size=min(DB_POOL_MIN_SIZE, max_size),
+            max_size=max_size,
+            max_inactive_connection_lifetime=DB_POOL_MAX_INACTIVE_SECONDS,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        )
+        pools[name] = pool
+        metrics["db_pool_max_size"].labels(pool=name).set(max_size)
+    return pool
+
+
+def get_redis(url):
+    """Shared client per Redis URL, on a bounded connection pool."""
+    client = redis_clients.get(url)
+    if client is None:
+        pool = redis_lib.BlockingConnectionPool.from_url(
+            url, max_connections=REDIS_MAX_CONNECTIONS, timeout=REDIS_POOL_TIMEOUT,
+        )
+        client = redis_clients[url] = redis_lib.Redis(connection_pool=pool)
+    return client
+
+
+def observe_pools():
+    for name, pool in pools.items():
+        in_use = pool.get_size() - pool.get_idle_size()
+        metrics["db_pool_connections"].labels(pool=name, state="in_use").set(in_use)
+        metrics["db_pool_connections"].labels(pool=name, state="idle").set(pool.get_idle_size())
+
+
+async def check_health():
+    for name, pool in pools.items():
+        started = time.perf_counter()
+        try:
+            async with pool.acquire(timeout=RESOURCE_HEALTH_SECONDS) as conn:
+                await conn.fetchval("SELECT 1")
+            metrics["resource_up"].labels(resource=f"postgres:{name}").set(1)
+        except Exception as e:
+            metrics["resource_up"].labels(resource=f"postgres:{name}").set(0)
+            log_event("resource_unhealthy", resource=f"postgres:{name}", error=str(e))
+        metrics["resource_ping_seconds"].labels(resource="postgres").observe(time.perf_counter() - started)
+    for index, client in enumerate(redis_clients.values()):
+        started = time.perf_counter()
+        try:
+            await client.ping()
+            metrics["resource_up"].labels(resource=f"redis:{index}").set(1)
+        except Exception as e:
+            metrics["resource_up"].labels(resource=f"redis:{index}").set(0)
+            log_event("resource_unhealthy", resource=f"redis:{index}", error=str(e))
+        metrics["resource_ping_seconds"].labels(resource="redis").observe(time.perf_counter() - started)
+
+
+async def watch_resources(interval=None):
+    """Pool usage every second, health checks every RESOURCE_HEALTH_SECONDS."""
+    interval = interval or RESOURCE_HEALTH_SECONDS
+    last_check = None
+    while True:
+        observe_pools()
+        if last_check is None or time.monotonic() - last_check >= interval:
+            last_check = time.monotonic()
+            await check_health()
+        await asyncio.sleep(1)
+
+
+async def close_all():
+    for client in redis_clients.values():
+        try:
+            await client.close()
+            await client.connection_pool.disconnect()
+        except Exception:
+            pass
+    redis_clients.clear()
+    for pool in pools.values():
+        await pool.close()
+    pools.clear()
@@ -0,0 +1,58 @@
+import os
+import hashlib
+
+# the legacy single stream; with STREAM_SHARDS > 0 it is only drained (see worker/shards.py)
+STREAM_BASE = "incoming:messages"
+STREAM_GROUP = "workers"
+# 0 = everything on STREAM_BASE, N = rooms hashed onto incoming:messages:{0..N-1}.
+# api and worker must agree; change it only while the streams are drained
+STREAM_SHARDS = int(os.getenv("STREAM_SHARDS", "0"))
+# comma separated Redis URLs holding the shard streams (shard i -> url i % count); empty = REDIS_URL
+STREAM_REDIS_URLS = [u.strip() for u in os.getenv("STREAM_REDIS_URLS", "").split(",") if u.strip()]
+
+
+def stream_key(shard):
+    return STREAM_BASE if shard is None else f"{STREAM_BASE}:{shard}"
+
+
+def shard_for(room_id, shards=None):
+    """Shard of a room: every message of one room lands on the same stream."""
+    shards = STREAM_SHARDS if shards is None else shards
+    if shards <= 0:
+        return None
+    if room_id is None:
+        room_id = b""
+    elif not isinstance(room_id, bytes):
+        # payloads may carry a numeric room id; it must hash like its string form
+        room_id = str(room_id).encode("utf-8")
+    # not crc32: the worker's lanes use crc32 % lanes, and a shard must still spread over all lanes
+    return int.from_bytes(hashlib.blake2b(room_id, digest_size=4).digest(), "big") % shards
+
+
+def node_for(shard):
+    """Index into STREAM_REDIS_URLS of the Redis holding `shard` (0 when not sharded)."""
+    if shard is None or not STREAM_REDIS_URLS:
+        return 0
+    return shard % len(STREAM_REDIS_URLS)
+
+
+def all_shards():
+    return list(range(STREAM_SHARDS)) if STREAM_SHARDS > 0 else [None]
+
+
+async def stream_stats(redis, stream, group):
+    """
+    Stream length, group lag (entries not yet delivered to the group) and
+    pending count (delivered but not ACKed).
+    """
+    length = await redis.xlen(stream)
+    lag = pending = 0
+    for info in await redis.xinfo_groups(stream):
+        name = info.get("name")
+        if isinstance(name, bytes):
+            name = name.decode()
+        if name == group:
+            # lag is only reported by redis >= 7 and can be unknown (None) after deletions
+            lag = info.get("lag") or 0
+            pending = info.get("pending") or 0
+    return length, lag, pending
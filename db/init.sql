@@ -7,8 +7,9 @@ CREATE TABLE IF NOT EXISTS rooms (
   last_activity_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
   raw_meta JSONB
 );
+CREATE INDEX IF NOT EXISTS idx_rooms_last_activity ON rooms(last_activity_at);
 
--- messages (raw)
+-- messages (raw); etl/maintenance.py --partition-messages converts it to monthly/daily range partitions
 CREATE TABLE IF NOT EXISTS messages (
   id BIGSERIAL PRIMARY KEY,
   room_id BIGINT REFERENCES rooms(id),
@@ -39,3 +40,30 @@ CREATE TABLE IF NOT EXISTS funnel (
 );
 
 CREATE INDEX IF NOT EXISTS idx_funnel_leadsdate ON funnel(leads_date);
+
+-- daily rollup of funnel, maintained incrementally by the funnel ETL (backs /funnel-report)
+CREATE TABLE IF NOT EXISTS funnel_daily (
+  leads_date DATE,
+  channel TEXT,
+  leads_count BIGINT NOT NULL DEFAULT 0,
+  bookings_count BIGINT NOT NULL DEFAULT 0,
+  transactions_count BIGINT NOT NULL DEFAULT 0,
+  transaction_value_sum NUMERIC NOT NULL DEFAULT 0,
+  UNIQUE NULLS NOT DISTINCT (leads_date, channel)
+);
+
+-- etl bookkeeping (incremental funnel watermark, last full rebuild)
+CREATE TABLE IF NOT EXISTS etl_state (
+  name TEXT PRIMARY KEY,
+  watermark TIMESTAMP WITH TIME ZONE,
+  updated_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+);
+
+-- replay/backfill from the MinIO archive: last loaded key per listing prefix
+CREATE TABLE IF NOT EXISTS replay_checkpoint (
+  name TEXT NOT NULL,
+  prefix TEXT NOT NULL,
+  last_key TEXT NOT NULL,
+  updated_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+  PRIMARY KEY (name, prefix)
+);
@@ -0,0 +1,50 @@
+"""
+Room partitions for running several funnel-etl processes/containers side by
+side. Room `id % ETL_PARTITIONS` is partition p; a worker only processes a
+partition while it holds the Postgres advisory lock (ADVISORY_NAMESPACE, p)
+on the connection doing the work. Locks are tried, never waited on, so N
+workers spread over the partitions, and a worker that dies drops its
+connection and with it the lock: the next cycle of any other worker picks
+the partition up.
+"""
+import os
+from contextlib import asynccontextmanager
+
+ETL_PARTITIONS = max(1, int(os.getenv("ETL_PARTITIONS", "1")))
+
+# first key of the two-int advisory lock form, so ids can't collide with other users of advisory locks
+ADVISORY_NAMESPACE = 0x46554E4C  # "FUNL"
+# singleton jobs, outside the 0..N-1 partition range
+ROLLUP_LOCK = -1
+MAINTENANCE_LOCK = -2
+
+
+def partition_order(worker_index, partitions=None):
+    """All partitions, starting at a different one per worker so workers don't queue on the same locks."""
+    partitions = partitions or ETL_PARTITIONS
+    start = worker_index % partitions
+    return [(start + i) % partitions for i in range(partitions)]
+
+
+def partition_suffix(partition, partitions=None):
+    """etl_state name suffix; empty for a single partition so existing watermarks keep working."""
+    partitions = partitions or ETL_PARTITIONS
+    return "" if partitions <= 1 else f":{partition}/{partitions}"
+
+
+@asynccontextmanager
+async def advisory_lock(pool, key):
+    """
+    Yields a pooled connection holding the session advisory lock `key`, or
+    None when another worker holds it.
+    """
+    async with pool.acquire() as conn:
+        if not await conn.fetchval("SELECT pg_try_advisory_lock($1, $2)", ADVISORY_NAMESPACE, key):
+            yield None
+            return
+        try:
+            yield conn
+        finally:
+            # the pool's connection reset also unlocks, this just frees it early
+            if not conn.is_closed():
+                await conn.execute("SELECT pg_advisory_unlock($1, $2)", ADVISORY_NAMESPACE, key)
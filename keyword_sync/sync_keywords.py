@@ -1,8 +1,9 @@
-import os, time, json, asyncio
+import os, time, asyncio
 import gspread
 from google.oauth2.service_account import Credentials
 import redis.asyncio as redis_lib
 import logging
+from common.keywords import CATEGORIES, apply_keywords
 
 logging.basicConfig(
     level=logging.INFO,
@@ -31,7 +32,7 @@ def get_keywords_from_sheet():
         data = ws.get_all_records()
 
         result = {}
-        for category in HARDCODED_KEYWORDS.keys():
+        for category in CATEGORIES:
             kws = [row[category].strip() for row in data if row.get(category) and row[category].strip()]
             result[category] = kws if kws else HARDCODED_KEYWORDS[category]
 
@@ -42,12 +43,16 @@ def get_keywords_from_sheet():
 
 async def push_to_redis(keywords_by_category):
     redis = await redis_lib.from_url(REDIS_URL)
-    for category, kws in keywords_by_category.items():
-        await redis.delete(f"keywords:{category}")
-        for k in kws:
-            await redis.sadd(f"keywords:{category}", k)
-        print(f"Pushed {len(kws)} keywords to Redis category '{category}'")
-    await redis.aclose()
+    try:
+        version, changed = await apply_keywords(redis, keywords_by_category)
+    finally:
+        await redis.aclose()
+    if changed:
+        for category in changed:
+            print(f"Pushed {len(set(keywords_by_category[category]))} keywords to Redis category '{category}'")
+        print(f"Keywords version {version}")
+    else:
+        print("Keywords unchanged, skipping Redis write")
 
 async def main_loop():
     while True:
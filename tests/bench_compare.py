@@ -0,0 +1,40 @@
+"""
+Diff two benchmark JSON result files (from bench_micro / bench_e2e /
+loadgen --json), e.g. the previous release against the current one.
+
+    python3 tests/bench_compare.py results/v1.2-e2e.json results/v1.3-e2e.json
+
+Prints every numeric result present in both, with the relative change.
+"""
+import sys, json, argparse
+
+def flatten(results, prefix=""):
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from flatten(value, name + ".")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, value
+
+def main(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    if base["benchmark"] != new["benchmark"]:
+        sys.exit(f"different benchmarks: {base['benchmark']} vs {new['benchmark']}")
+
+    print(f"{base['benchmark']}: {base.get('git_revision')} -> {new.get('git_revision')}")
+    new_values = dict(flatten(new["results"]))
+    for name, old in flatten(base["results"]):
+        if name not in new_values:
+            continue
+        value = new_values[name]
+        change = f"{(value - old) / old * 100:+.1f}%" if old else "n/a"
+        print(f"{name:>40} {old:>14.2f} {value:>14.2f} {change:>9}")
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("base")
+    ap.add_argument("new")
+    main(ap.parse_args())
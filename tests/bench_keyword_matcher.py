@@ -0,0 +1,71 @@
+"""
+Microbenchmark: per-keyword `kw in text` scans (old run_funnel_etl) vs the
+compiled KeywordMatcher, scaling the keyword count from 10 to 10k.
+
+    python3 tests/bench_keyword_matcher.py
+"""
+import os, sys, time, random, string
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from common.keyword_matcher import KeywordMatcher  # noqa: E402
+
+SIZES = [10, 100, 1000, 10000]
+MESSAGES = 2000
+
+BASE_TEXTS = [
+    "halo kak, mau tanya promo bulan ini",
+    "saya mau booking 2025-10-01 untuk 2 orang",
+    "sudah transfer 1.500.000 ya kak",
+    "ok kak ditunggu konfirmasinya",
+    "terima kasih banyak, pelayanannya cepat sekali",
+]
+
+def random_word(rnd):
+    return "".join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(4, 12)))
+
+def make_keywords(n, rnd):
+    per_cat = max(1, n // 3)
+    opening = ["halo"] + [random_word(rnd) for _ in range(per_cat - 1)]
+    booking = ["booking"] + [random_word(rnd) for _ in range(per_cat - 1)]
+    transaction = ["transfer"] + [random_word(rnd) for _ in range(n - 2 * per_cat - 1)]
+    return opening, booking, transaction
+
+def naive_match(text, opening, booking, transaction):
+    opening_keyword = None
+    for kw in opening:
+        if kw and kw in text:
+            opening_keyword = kw
+            break
+    is_booking = any(kw in text for kw in booking)
+    is_transaction = any(kw in text for kw in transaction)
+    return opening_keyword, is_booking, is_transaction
+
+def bench(fn, texts):
+    t0 = time.perf_counter()
+    for t in texts:
+        fn(t)
+    return (time.perf_counter() - t0) / len(texts) * 1e6
+
+def main():
+    rnd = random.Random(42)
+    texts = [rnd.choice(BASE_TEXTS) for _ in range(MESSAGES)]
+
+    print(f"{'keywords':>9} {'naive us/msg':>13} {'matcher us/msg':>15} {'compile ms':>11} {'speedup':>8}")
+    for n in SIZES:
+        opening, booking, transaction = make_keywords(n, rnd)
+
+        t0 = time.perf_counter()
+        matcher = KeywordMatcher(opening, booking, transaction)
+        compile_ms = (time.perf_counter() - t0) * 1e3
+
+        for t in BASE_TEXTS:
+            naive = naive_match(t, opening, booking, transaction)
+            got = matcher.match(t)
+            assert (naive[0] is None) == (got[0] is None) and naive[1:] == got[1:], (t, naive, got)
+
+        naive_us = bench(lambda t: naive_match(t, opening, booking, transaction), texts)
+        matcher_us = bench(matcher.match, texts)
+        print(f"{n:>9} {naive_us:>13.2f} {matcher_us:>15.2f} {compile_ms:>11.1f} {naive_us / matcher_us:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
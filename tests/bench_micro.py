@@ -0,0 +1,124 @@
+"""
+Offline microbenchmarks for the pure, CPU-bound pieces of the pipeline,
+fed with conversations from tests/loadgen.py (same channel / keyword mix):
+
+  classify       common.funnel.classify_room per room (ETL)
+  extract        fastjson.loads + worker.extract_message per stream entry (worker)
+  webhook_parse  fastjson parse + extract_route + stream_entry per /webhook body (API)
+  batch_parse    parse_batch_body for an NDJSON /webhook/batch body (API)
+
+    python3 tests/bench_micro.py --rooms 5000 --json micro.json
+
+Needs no running services, only the api/worker/etl requirements.
+"""
+import os, sys, json, time, random, argparse, datetime, statistics
+
+HERE = os.path.dirname(__file__)
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, os.path.join(HERE, "..", "worker"))
+sys.path.insert(0, os.path.join(HERE, "..", "api"))
+import worker  # noqa: E402
+from app import main as api_main  # noqa: E402
+from common import fastjson  # noqa: E402
+from common.funnel import classify_room  # noqa: E402
+from common.keyword_matcher import KeywordMatcher, BOOKING_KEYWORDS, TRANSACTION_KEYWORDS  # noqa: E402
+from benchlib import write_results  # noqa: E402
+import loadgen  # noqa: E402
+
+def make_corpus(args):
+    ap = argparse.ArgumentParser()
+    loadgen.add_load_args(ap)
+    load_args = ap.parse_args(["--seed", str(args.seed)])
+    rnd = random.Random(args.seed)
+    return [loadgen.make_room(rnd, f"bench-{i}", load_args)[0] for i in range(args.rooms)]
+
+def best_of(repeat, fn):
+    """Run fn() repeat times, return (best, median) wall seconds."""
+    runs = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - t0)
+    return min(runs), statistics.median(runs)
+
+def bench_classify(rooms):
+    matcher = KeywordMatcher(loadgen.OPENING_KEYWORDS, BOOKING_KEYWORDS, TRANSACTION_KEYWORDS)
+    msgs = []
+    for payloads in rooms:
+        msgs.append([{
+            "content": p["message"]["text"],
+            "phone": p["sender"]["phone"],
+            "raw_payload": json.dumps(p),  # jsonb comes back from asyncpg as text
+            "created_at": datetime.datetime.fromisoformat(p["timestamp"]),
+        } for p in payloads])
+
+    def run():
+        for m in msgs:
+            classify_room(m, matcher)
+    return run, len(msgs), "rooms"
+
+def bench_extract(rooms):
+    now = datetime.datetime.utcnow()
+    entries = [
+        ({"room_id": p["room_id"], "provider": p["channel"]}, json.dumps(p).encode())
+        for payloads in rooms for p in payloads
+    ]
+
+    def run():
+        for data, raw in entries:
+            worker.extract_message(data, fastjson.loads(raw), now, raw)
+    return run, len(entries), "msgs"
+
+def bench_webhook_parse(rooms):
+    bodies = [json.dumps(p).encode() for payloads in rooms for p in payloads]
+    ts = datetime.datetime.utcnow().isoformat()
+
+    def run():
+        for body in bodies:
+            channel, room_id = api_main.extract_route(fastjson.loads(body))
+            api_main.stream_entry(channel, room_id, f"raw/{channel}/{room_id}/{ts}.json", ts, body, False)
+    return run, len(bodies), "msgs"
+
+def bench_batch_parse(rooms):
+    body = b"\n".join(json.dumps(p).encode() for payloads in rooms for p in payloads)
+    items = body.count(b"\n") + 1
+
+    def run():
+        api_main.parse_batch_body(body, "application/x-ndjson")
+    return run, items, "msgs"
+
+BENCHES = {
+    "classify": bench_classify,
+    "extract": bench_extract,
+    "webhook_parse": bench_webhook_parse,
+    "batch_parse": bench_batch_parse,
+}
+
+def main(args):
+    rooms = make_corpus(args)
+    print(f"corpus: {len(rooms)} rooms, {sum(len(r) for r in rooms)} messages")
+    print(f"{'bench':>14} {'items':>8} {'best/s':>12} {'median/s':>12} {'us/item':>9}")
+    results = {}
+    for name in args.benches:
+        run, items, unit = BENCHES[name](rooms)
+        best, median = best_of(args.repeat, run)
+        results[name] = {
+            "items": items,
+            "unit": unit,
+            f"{unit}_per_s": round(items / best, 1),
+            f"{unit}_per_s_median": round(items / median, 1),
+            "us_per_item": round(best / items * 1e6, 3),
+        }
+        print(f"{name:>14} {items:>8} {items / best:>12.0f} {items / median:>12.0f} {best / items * 1e6:>9.2f}")
+    if args.json:
+        write_results(args.json, "micro", vars(args), results)
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rooms", type=int, default=5000)
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--benches", nargs="+", default=list(BENCHES), choices=list(BENCHES))
+    ap.add_argument("--json", help="write results as JSON to this path ('-' for stdout)")
+    main(ap.parse_args())
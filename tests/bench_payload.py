@@ -0,0 +1,109 @@
+"""
+CPU time per message of the payload path, before and after keeping the
+request bytes end to end:
+
+  before  API: json.loads + json.dumps for the archive/stream copy
+          worker: json.loads + dateutil timestamp + json.dumps raw_payload/meta
+  after   API: fastjson.loads for routing, request bytes forwarded as is
+          worker: fastjson.loads + fromisoformat fast path, bytes stored verbatim
+
+The "before" side is the previous code, kept here as the baseline.
+
+    python3 tests/bench_payload.py --rooms 5000 --json payload.json
+
+Needs no running services, only the api/worker requirements (orjson
+optional: without it "after" runs on stdlib json).
+"""
+import os, sys, json, time, argparse, datetime
+
+HERE = os.path.dirname(__file__)
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, os.path.join(HERE, "..", "worker"))
+sys.path.insert(0, os.path.join(HERE, "..", "api"))
+from dateutil import parser as dateparser  # noqa: E402
+import worker  # noqa: E402
+from app import main as api_main  # noqa: E402
+from common import fastjson  # noqa: E402
+from benchlib import write_results  # noqa: E402
+from bench_micro import make_corpus  # noqa: E402
+
+def api_before(body, ts):
+    data = json.loads(body)
+    channel, room_id = api_main.extract_route(data)
+    raw_bytes = json.dumps(data).encode("utf-8")
+    return api_main.stream_entry(channel, room_id, f"raw/{channel}/{room_id}/{ts}.json", ts, raw_bytes, False)
+
+def api_after(body, ts):
+    channel, room_id = api_main.extract_route(fastjson.loads(body))
+    return api_main.stream_entry(channel, room_id, f"raw/{channel}/{room_id}/{ts}.json", ts, body, False)
+
+def worker_before(data, raw, now):
+    payload = json.loads(raw)
+    message = payload.get("message", {}) or {}
+    sender = payload.get("sender", {}) or {}
+    timestamp_str = payload.get("timestamp")
+    try:
+        created_at = dateparser.parse(timestamp_str) if timestamp_str else now
+    except (ValueError, OverflowError, TypeError):
+        created_at = now
+    return {
+        "room_key": data.get("room_id"),
+        "channel": payload.get("channel", "unknown"),
+        "meta": json.dumps(payload.get("meta") or {}),
+        "msg_id": message.get("id") or payload.get("msg_id"),
+        "sender_type": sender.get("type") or payload.get("sender_type"),
+        "sender_id": sender.get("id"),
+        "phone": sender.get("phone") or payload.get("phone"),
+        "content": message.get("text") or json.dumps(payload.get("message") or {}),
+        "raw_payload": json.dumps(payload),
+        "created_at": created_at,
+    }
+
+def worker_after(data, raw, now):
+    return worker.extract_message(data, fastjson.loads(raw), now, raw)
+
+def cpu_per_item(repeat, fn, items):
+    """Best CPU (process) time per item over `repeat` runs, in microseconds."""
+    best = None
+    for _ in range(repeat):
+        t0 = time.process_time()
+        for item in items:
+            fn(*item)
+        spent = time.process_time() - t0
+        best = spent if best is None else min(best, spent)
+    return best / len(items) * 1e6
+
+def main(args):
+    bodies = [json.dumps(p).encode() for payloads in make_corpus(args) for p in payloads]
+    ts = datetime.datetime.utcnow().isoformat()
+    now = datetime.datetime.utcnow()
+    api_items = [(body, ts) for body in bodies]
+    worker_items = [({"room_id": "r", "provider": "whatsapp", "raw_object_key": "k"}, body, now) for body in bodies]
+    print(f"corpus: {len(bodies)} messages, json backend: {'orjson' if fastjson.orjson else 'stdlib'}")
+
+    results = {"messages": len(bodies)}
+    print(f"{'path':>8} {'before us/msg':>14} {'after us/msg':>13} {'speedup':>8}")
+    for name, before, after, items in (
+        ("api", api_before, api_after, api_items),
+        ("worker", worker_before, worker_after, worker_items),
+    ):
+        b = cpu_per_item(args.repeat, before, items)
+        a = cpu_per_item(args.repeat, after, items)
+        results[name] = {"before_us_per_msg": round(b, 3), "after_us_per_msg": round(a, 3), "speedup": round(b / a, 2)}
+        print(f"{name:>8} {b:>14.2f} {a:>13.2f} {b / a:>7.1f}x")
+    total_before = results["api"]["before_us_per_msg"] + results["worker"]["before_us_per_msg"]
+    total_after = results["api"]["after_us_per_msg"] + results["worker"]["after_us_per_msg"]
+    results["total"] = {"before_us_per_msg": round(total_before, 3), "after_us_per_msg": round(total_after, 3),
+                        "speedup": round(total_before / total_after, 2)}
+    print(f"{'total':>8} {total_before:>14.2f} {total_after:>13.2f} {total_before / total_after:>7.1f}x")
+    if args.json:
+        write_results(args.json, "payload", vars(args), results)
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rooms", type=int, default=2000)
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", help="write results as JSON to this path ('-' for stdout)")
+    main(ap.parse_args())
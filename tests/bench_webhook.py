@@ -0,0 +1,91 @@
+"""
+In-process /webhook latency benchmark under concurrent load, with a fake
+MinIO whose put_object blocks for --s3-latency ms (like boto3 does).
+
+Variants:
+  blocking      put_object on the event loop (previous behaviour, S3_UPLOAD_THREADS=0)
+  threadpool    ARCHIVE_MODE=sync, upload on the bounded thread pool
+  write_behind  ARCHIVE_MODE=write_behind, ack after XADD
+
+    python3 tests/bench_webhook.py --requests 2000 --concurrency 100 --s3-latency 20
+
+Needs the api requirements plus httpx and fakeredis.
+"""
+import os, sys, time, asyncio, logging, argparse, statistics
+import httpx
+import fakeredis
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api"))
+from app import main  # noqa: E402
+from app.utils_s3 import S3Archiver  # noqa: E402
+
+logging.getLogger("app_logger").setLevel(logging.WARNING)
+
+VARIANTS = {
+    "blocking": ("sync", 0),
+    "threadpool": ("sync", 16),
+    "write_behind": ("write_behind", 16),
+}
+
+class SlowS3:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def put_object(self, **kwargs):
+        time.sleep(self.latency)
+        return {}
+
+def payload(i):
+    return {
+        "room_id": f"room-{i % 500}",
+        "channel": "whatsapp",
+        "sender": {"type": "customer", "phone": "08123456789"},
+        "message": {"id": f"msg-{i}", "text": "halo kak, mau booking 2025-10-01"},
+        "timestamp": "2025-10-01T10:00:00",
+    }
+
+async def run_variant(name, args):
+    archive_mode, threads = VARIANTS[name]
+    main.ARCHIVE_MODE = archive_mode
+    main.app.state.redis = fakeredis.FakeAsyncRedis()
+    # what the lifespan sets up without STREAM_REDIS_URLS: streams on the main Redis
+    main.app.state.stream_nodes = [main.app.state.redis]
+    main.app.state.stream_lag = 0
+    main.app.state.archiver = S3Archiver(SlowS3(args.s3_latency / 1000), "bench", threads=threads, max_inflight=threads * 4 or 1)
+    if archive_mode == "write_behind":
+        main.app.state.archiver.start()
+
+    latencies = []
+    sem = asyncio.Semaphore(args.concurrency)
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def one(i):
+            async with sem:
+                t0 = time.perf_counter()
+                r = await client.post("/webhook", json=payload(i))
+                latencies.append(time.perf_counter() - t0)
+                assert r.status_code == 200, r.text
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(args.requests)))
+        elapsed = time.perf_counter() - t0
+
+    await main.app.state.archiver.close()
+    latencies.sort()
+    p50 = statistics.median(latencies) * 1e3
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1e3
+    print(f"{name:>13} {p50:9.1f} {p99:9.1f} {args.requests / elapsed:10.0f}")
+
+async def amain(args):
+    print(f"{'variant':>13} {'p50 ms':>9} {'p99 ms':>9} {'req/s':>10}")
+    for name in args.variants:
+        await run_variant(name, args)
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--requests", type=int, default=2000)
+    ap.add_argument("--concurrency", type=int, default=100)
+    ap.add_argument("--s3-latency", type=float, default=20, help="simulated MinIO round trip in ms")
+    ap.add_argument("--variants", nargs="+", default=list(VARIANTS), choices=list(VARIANTS))
+    asyncio.run(amain(ap.parse_args()))
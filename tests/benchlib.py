@@ -0,0 +1,46 @@
+"""
+Small helpers shared by the benchmark scripts: percentiles and the JSON
+result file format, so runs from different releases can be diffed with
+tests/bench_compare.py.
+"""
+import os, sys, json, socket, platform, datetime, subprocess
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+def percentile(values, q):
+    """q in [0, 100]; nearest-rank on a copy of values, None when empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except Exception:
+        return None
+
+def write_results(path, benchmark, params, results):
+    """
+    {"benchmark", "created_at", "git_revision", "host", "python", "params", "results"}
+    where results is a flat-ish dict of numbers (nested one level per case).
+    """
+    doc = {
+        "benchmark": benchmark,
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "git_revision": git_revision(),
+        "host": socket.gethostname(),
+        "python": platform.python_version(),
+        "params": params,
+        "results": results,
+    }
+    if path == "-":
+        json.dump(doc, sys.stdout, indent=2, default=str)
+        print()
+        return
+    with open(path, "w") as f:
+        json.dump(doc, f, indent=2, default=str)
+    print(f"results written to {path}")
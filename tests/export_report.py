@@ -1,6 +1,10 @@
 import psycopg2
-import csv
+import argparse
 import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api"))
+from app.export import FUNNEL_EXPORT_SQL, FORMATS, is_reject, make_sink  # noqa: E402
 
 DB_CONFIG = {
     "dbname": "sparks",
@@ -12,50 +16,61 @@ DB_CONFIG = {
 
 FUNNEL_CSV = os.getenv("FUNNEL_CSV", "funnel_report.csv")
 REJECT_CSV = os.getenv("REJECT_CSV", "funnel_reject.csv")
+CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "5000"))
 
-def export_funnel_to_csv():
+def output_path(path, fmt):
+    return os.path.splitext(path)[0] + "." + FORMATS[fmt][1]
+
+def export_funnel(fmt="csv"):
+    """
+    One pass over funnel through a named (server-side) cursor: every row
+    goes to the report, rows with missing fields also go to the reject file.
+    Memory stays bounded by CHUNK_ROWS whatever the table size.
+    """
     conn = psycopg2.connect(**DB_CONFIG)
-    cur = conn.cursor()
-
-    cur.execute("""
-        SELECT id, room_id, leads_date, channel, phone, booking_date, transaction_date, transaction_value, opening_keyword
-        FROM funnel
-        ORDER BY leads_date;
-    """)
-    rows = cur.fetchall()
-    headers = [desc[0] for desc in cur.description]
-
-    with open(FUNNEL_CSV, "w", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(headers)
-        writer.writerows(rows)
-    print(f"Funnel report exported to {FUNNEL_CSV} ({len(rows)} rows)")
-
-    cur.execute("""
-        SELECT id, room_id, leads_date, channel, phone, booking_date, transaction_date, transaction_value, opening_keyword
-        FROM funnel
-        WHERE leads_date IS NULL
-           OR phone IS NULL
-           OR booking_date IS NULL
-           OR transaction_date IS NULL
-           OR transaction_value IS NULL
-           OR opening_keyword IS NULL
-        ORDER BY id;
-    """)
-    reject_rows = cur.fetchall()
-
-    if reject_rows:
-        with open(REJECT_CSV, "w", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow(headers)
-            writer.writerows(reject_rows)
-        print(f"Reject report exported to {REJECT_CSV} ({len(reject_rows)} rows)")
+    cur = conn.cursor(name="funnel_export")
+    cur.itersize = CHUNK_ROWS
+    cur.execute(FUNNEL_EXPORT_SQL)
+
+    funnel_path = output_path(FUNNEL_CSV, fmt)
+    reject_path = output_path(REJECT_CSV, fmt)
+    funnel_file = open(funnel_path, "wb")
+    funnel_sink = make_sink(fmt, funnel_file)
+    reject_file = reject_sink = None
+
+    try:
+        while True:
+            rows = cur.fetchmany(CHUNK_ROWS)
+            if not rows:
+                break
+            funnel_sink.write_rows(rows)
+            rejects = [r for r in rows if is_reject(r)]
+            if rejects:
+                if reject_sink is None:
+                    reject_file = open(reject_path, "wb")
+                    reject_sink = make_sink(fmt, reject_file)
+                reject_sink.write_rows(rejects)
+    finally:
+        funnel_sink.close()
+        funnel_file.close()
+        if reject_sink is not None:
+            reject_sink.close()
+            reject_file.close()
+        cur.close()
+        conn.close()
+
+    print(f"Funnel report exported to {funnel_path} ({funnel_sink.rows} rows)")
+    if reject_sink is not None:
+        print(f"Reject report exported to {reject_path} ({reject_sink.rows} rows)")
     else:
         print("No rejected rows found.")
 
-    cur.close()
-    conn.close()
+
+def export_funnel_to_csv():
+    export_funnel("csv")
 
 
 if __name__ == "__main__":
-    export_funnel_to_csv()
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--format", choices=list(FORMATS), default="csv")
+    export_funnel(ap.parse_args().format)
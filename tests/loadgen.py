@@ -0,0 +1,221 @@
+"""
+Async load generator for the webhook API. Opens --rate rooms per second
+(open loop: rooms are started on schedule even if earlier ones are still
+sending), each with a realistic conversation: channel mix, a skewed message
+count, and opening / booking / transaction keywords with the given odds.
+
+    python3 tests/loadgen.py --rooms 20000 --rate 2000 --concurrency 200
+    python3 tests/loadgen.py --rooms 20000 --rate 2000 --batch 500 --json loadgen.json
+
+Messages of one room are always sent in order (single requests) or inside the
+same /webhook/batch call, like a real provider would. Needs httpx.
+"""
+import os, sys, json, time, uuid, random, asyncio, argparse, datetime
+import httpx
+
+sys.path.insert(0, os.path.dirname(__file__))
+from benchlib import percentile, write_results  # noqa: E402
+
+CHANNEL_MIX = {"whatsapp": 0.6, "ads": 0.25, "website": 0.15}
+OPENING_KEYWORDS = ["halo", "hai", "selamat pagi"]
+
+CUSTOMER_FILLER = [
+    "mau tanya harga paket bulan ini",
+    "lokasinya di mana ya kak",
+    "bisa untuk 2 orang?",
+    "ok kak",
+    "promo masih ada?",
+]
+AGENT_FILLER = [
+    "baik kak, kami bantu ya",
+    "harga paket mulai 1.200.000 kak",
+    "bisa kak, silakan",
+    "ditunggu kabarnya kak",
+]
+
+def pick_channel(rnd):
+    r = rnd.random()
+    for channel, share in CHANNEL_MIX.items():
+        r -= share
+        if r < 0:
+            return channel
+    return channel
+
+def message_count(rnd, mean, maximum):
+    # most rooms are short, a long tail is not
+    return max(1, min(maximum, int(rnd.expovariate(1 / mean)) + 1))
+
+def make_room(rnd, room_id, args, start=None):
+    """
+    Returns (payloads, expected) where expected is what the funnel row for
+    this room should end up with once the whole pipeline caught up.
+    """
+    channel = pick_channel(rnd)
+    phone = f"08{rnd.randint(10**9, 10**10 - 1)}"
+    opening = rnd.random() < args.p_opening
+    booking = rnd.random() < args.p_booking
+    transaction = booking and rnd.random() < args.p_transaction
+
+    texts = [("customer", f"{rnd.choice(args.opening_keywords)} kak" if opening else rnd.choice(CUSTOMER_FILLER))]
+    if booking:
+        day = datetime.date.today() + datetime.timedelta(days=rnd.randint(1, 60))
+        texts.append(("customer", f"saya mau booking {day.isoformat()}"))
+    if transaction:
+        texts.append(("customer", f"sudah transfer {rnd.randint(5, 50) * 100}.000"))
+    total = message_count(rnd, args.mean_msgs, args.max_msgs)
+    while len(texts) < total:
+        # filler goes between the keyword messages, keeping their order
+        sender = rnd.choice(["agent", "customer"])
+        texts.insert(rnd.randint(1, len(texts)), (sender, rnd.choice(AGENT_FILLER if sender == "agent" else CUSTOMER_FILLER)))
+
+    start = start or datetime.datetime.utcnow()
+    payloads = []
+    for i, (sender, text) in enumerate(texts):
+        payloads.append({
+            "room_id": room_id,
+            "channel": channel,
+            "sender": {"type": sender, "phone": phone if sender == "customer" else None},
+            "message": {"id": f"{room_id}-{i}", "text": text},
+            "timestamp": (start + datetime.timedelta(seconds=i)).isoformat(),
+        })
+    expected = {"booking": booking, "transaction": transaction, "messages": len(payloads)}
+    return payloads, expected
+
+class LoadGenerator:
+    """
+    Drives the API and records per-request latency plus, per room, the time
+    its last message was acknowledged (room_acked, time.monotonic()).
+    """
+
+    def __init__(self, args, run_id=None):
+        self.args = args
+        self.run_id = run_id or uuid.uuid4().hex[:8]
+        self.rnd = random.Random(args.seed)
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        self.rejected = 0
+        self.messages_acked = 0
+        self.expected = {}
+        self.room_acked = {}
+        self.elapsed = 0.0
+
+    def room_prefix(self):
+        return f"lg-{self.run_id}-"
+
+    async def post(self, client, path, **kwargs):
+        for attempt in range(self.args.retries + 1):
+            t0 = time.perf_counter()
+            try:
+                r = await client.post(path, **kwargs)
+            except httpx.HTTPError:
+                self.errors += 1
+                await asyncio.sleep(0.1)
+                continue
+            self.latencies.append(time.perf_counter() - t0)
+            self.statuses[r.status_code] = self.statuses.get(r.status_code, 0) + 1
+            if r.status_code in (429, 503):
+                self.rejected += 1
+                await asyncio.sleep(min(float(r.headers.get("Retry-After", "1")), 5.0))
+                continue
+            return r.status_code == 200
+        return False
+
+    async def send_room(self, client, sem, room_id, payloads):
+        for payload in payloads:
+            async with sem:
+                ok = await self.post(client, "/webhook", json=payload)
+            if not ok:
+                return
+            self.messages_acked += 1
+        self.room_acked[room_id] = time.monotonic()
+
+    async def send_batch(self, client, sem, rooms):
+        body = "\n".join(json.dumps(p) for _, payloads in rooms for p in payloads)
+        async with sem:
+            ok = await self.post(client, "/webhook/batch", content=body, headers={"Content-Type": "application/x-ndjson"})
+        if ok:
+            acked = time.monotonic()
+            for room_id, payloads in rooms:
+                self.messages_acked += len(payloads)
+                self.room_acked[room_id] = acked
+
+    async def run(self, base_url):
+        args = self.args
+        sem = asyncio.Semaphore(args.concurrency)
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        tasks = set()
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=args.timeout) as client:
+            t0 = time.monotonic()
+            batch, batch_msgs = [], 0
+            for i in range(args.rooms):
+                delay = t0 + i / args.rate - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                room_id = f"{self.room_prefix()}{i}"
+                payloads, expected = make_room(self.rnd, room_id, args)
+                self.expected[room_id] = expected
+
+                if args.batch:
+                    batch.append((room_id, payloads))
+                    batch_msgs += len(payloads)
+                    if batch_msgs < args.batch:
+                        continue
+                    task = asyncio.create_task(self.send_batch(client, sem, batch))
+                    batch, batch_msgs = [], 0
+                else:
+                    task = asyncio.create_task(self.send_room(client, sem, room_id, payloads))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if batch:
+                tasks.add(asyncio.create_task(self.send_batch(client, sem, batch)))
+            await asyncio.gather(*tasks)
+            self.elapsed = time.monotonic() - t0
+
+    def summary(self):
+        ms = [round(v * 1e3, 2) for v in self.latencies]
+        return {
+            "rooms_sent": len(self.expected),
+            "rooms_acked": len(self.room_acked),
+            "messages_acked": self.messages_acked,
+            "requests": len(self.latencies),
+            "status_counts": {str(k): v for k, v in sorted(self.statuses.items())},
+            "rejected": self.rejected,
+            "transport_errors": self.errors,
+            "elapsed_s": round(self.elapsed, 3),
+            "rooms_per_s": round(len(self.room_acked) / self.elapsed, 1) if self.elapsed else None,
+            "ingest_msgs_per_s": round(self.messages_acked / self.elapsed, 1) if self.elapsed else None,
+            "request_p50_ms": percentile(ms, 50),
+            "request_p99_ms": percentile(ms, 99),
+        }
+
+def add_load_args(ap):
+    ap.add_argument("--rooms", type=int, default=5000)
+    ap.add_argument("--rate", type=float, default=500, help="rooms started per second")
+    ap.add_argument("--concurrency", type=int, default=100, help="max in-flight HTTP requests")
+    ap.add_argument("--batch", type=int, default=0, help="use /webhook/batch with ~N messages per call")
+    ap.add_argument("--mean-msgs", type=float, default=6, help="mean messages per room")
+    ap.add_argument("--max-msgs", type=int, default=40)
+    ap.add_argument("--p-opening", type=float, default=0.7, help="share of rooms opening with a keyword")
+    ap.add_argument("--p-booking", type=float, default=0.4)
+    ap.add_argument("--p-transaction", type=float, default=0.5, help="share of bookings that pay")
+    ap.add_argument("--opening-keywords", type=lambda s: s.split(","), default=OPENING_KEYWORDS)
+    ap.add_argument("--retries", type=int, default=3, help="retries on 429/503 backpressure")
+    ap.add_argument("--timeout", type=float, default=30)
+    ap.add_argument("--seed", type=int, default=1)
+
+async def amain(args):
+    gen = LoadGenerator(args)
+    await gen.run(args.api)
+    summary = gen.summary()
+    for k, v in summary.items():
+        print(f"{k:>18}: {v}")
+    if args.json:
+        write_results(args.json, "loadgen", vars(args), summary)
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--api", default=os.getenv("API_URL", "http://localhost:8000"))
+    ap.add_argument("--json", help="write results as JSON to this path ('-' for stdout)")
+    add_load_args(ap)
+    asyncio.run(amain(ap.parse_args()))
@@ -0,0 +1,77 @@
+import asyncio
+from common.observability import log_event, metrics
+from common.streams import stream_stats
+
+
+class BacklogManager:
+    """
+    Keeps an eye on the consumer group: publishes stream length / lag /
+    pending gauges, XAUTOCLAIMs entries left idle by crashed consumers,
+    and tunes the xreadgroup count/block to the current lag.
+    """
+
+    def __init__(self, streams, group, consumer_name, lanes,
+                 base_count, max_count, idle_ms=60000, interval=5.0, claim_count=500):
+        # callable -> [(redis client, stream key)] this consumer currently reads
+        self.streams = streams
+        self.group = group
+        self.consumer_name = consumer_name
+        self.lanes = lanes
+        self.base_count = base_count
+        self.max_count = max_count
+        self.idle_ms = idle_ms
+        self.interval = interval
+        self.claim_count = claim_count
+        self.lag = 0
+
+    def read_params(self):
+        """
+        (count, block_ms) for the next xreadgroup: read bigger batches while
+        behind, and long-poll only when caught up.
+        """
+        if self.lag <= self.base_count:
+            return self.base_count, 5000
+        return min(self.max_count, max(self.base_count, self.lag // 2)), 100
+
+    async def refresh(self):
+        total_length = total_lag = total_pending = 0
+        for redis, stream in self.streams():
+            length, lag, pending = await stream_stats(redis, stream, self.group)
+            metrics["redis_stream_shard_lag"].labels(stream=stream).set(lag)
+            total_length += length
+            total_lag += lag
+            total_pending += pending
+        self.lag = total_lag
+        metrics["redis_stream_length"].set(total_length)
+        metrics["redis_group_lag"].set(total_lag)
+        metrics["redis_messages_pending"].set(total_pending)
+
+    async def reclaim(self, redis, stream):
+        start = "0-0"
+        claimed = 0
+        while True:
+            resp = await redis.xautoclaim(
+                stream, self.group, self.consumer_name,
+                min_idle_time=self.idle_ms, start_id=start, count=self.claim_count,
+            )
+            start, messages = resp[0], resp[1]
+            for msg_id, fields in messages:
+                # deleted entries come back without fields; entries still queued in our own lanes are skipped
+                if fields and not self.lanes.is_inflight(stream, msg_id):
+                    await self.lanes.submit(stream, msg_id, fields)
+                    claimed += 1
+            if start in (b"0-0", "0-0") or not messages:
+                break
+        if claimed:
+            metrics["redis_messages_reclaimed"].inc(claimed)
+            log_event("pending_reclaimed", stream=stream, count=claimed)
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+                for redis, stream in self.streams():
+                    await self.reclaim(redis, stream)
+            except Exception as e:
+                log_event("backlog_error", error=str(e))
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,280 @@
+"""
+Replay / backfill rooms + messages from the raw MinIO archive, then have the
+funnel ETL do a full rebuild.
+
+Reads both archive layouts:
+  raw/{channel}/{room_id}/{ts}.json       one payload per /webhook call
+  raw/batch/{date}/{ts}-{id}.ndjson       one segment per /webhook/batch call
+
+Objects are listed per prefix in key order and handled in chunks: fetched
+concurrently (thread pool), parsed with worker.extract_message in a process
+pool, COPYed into a staging table and merged into rooms/messages. Each chunk
+commits together with its checkpoint, so --resume carries on where a killed
+run stopped.
+
+    python replay.py --since 2025-10-01 --until 2025-10-31
+    python replay.py --channel whatsapp --channel ads --resume
+"""
+import os, time, asyncio, hashlib, argparse, datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import asyncpg
+from common.observability import log_event
+from common import fastjson
+from common.funnel import request_full_rebuild
+from worker import DATABASE_URL, RAW_BUCKET, extract_message, s3_client
+
+# objects per chunk (one DB transaction + checkpoint per chunk)
+REPLAY_CHUNK_SIZE = int(os.getenv("REPLAY_CHUNK_SIZE", "2000"))
+REPLAY_FETCH_CONCURRENCY = int(os.getenv("REPLAY_FETCH_CONCURRENCY", "64"))
+REPLAY_PROCESSES = int(os.getenv("REPLAY_PROCESSES", str(os.cpu_count() or 2)))
+# chunks fetched/parsed ahead of the one being loaded
+REPLAY_PREFETCH = int(os.getenv("REPLAY_PREFETCH", "4"))
+
+STAGING_COLUMNS = [
+    "room_key", "channel", "meta", "msg_id", "sender_type", "sender_id",
+    "phone", "content", "raw_payload", "created_at",
+]
+
+def key_timestamp(key):
+    """Archive time encoded in the object name (utcnow().isoformat() at the API)."""
+    name = key.rsplit("/", 1)[-1]
+    if key.startswith("raw/batch/"):
+        name = name.rsplit("-", 1)[0]
+    else:
+        name = name[:-len(".json")] if name.endswith(".json") else name
+    try:
+        return datetime.datetime.fromisoformat(name)
+    except ValueError:
+        return None
+
+def batch_route(data, key, offset):
+    # same precedence as the API's extract_route; unknown rooms get a stable id so re-runs agree
+    channel = data.get("channel") or data.get("source") or "unknown"
+    room_id = data.get("room_id") or data.get("room", {}).get("id") or data.get("roomId")
+    if not room_id:
+        room_id = f"room_unknown_{hashlib.sha1(f'{key}:{offset}'.encode()).hexdigest()[:8]}"
+    return channel, room_id
+
+def staging_row(row):
+    return tuple(row[c] for c in STAGING_COLUMNS)
+
+def parse_objects(objects, channels):
+    """
+    Process pool entry point: [(key, body bytes)] -> staging rows. Uses the
+    same extraction as the live worker; the archive time stands in for
+    "now" when a payload has no usable timestamp.
+    """
+    rows = []
+    for key, body in objects:
+        received = key_timestamp(key) or datetime.datetime.utcnow()
+        if key.startswith("raw/batch/"):
+            offset = 0
+            for line in body.split(b"\n"):
+                if line.strip():
+                    try:
+                        payload = fastjson.loads(line)
+                    except ValueError:
+                        payload = None
+                    if isinstance(payload, dict):
+                        channel, room_id = batch_route(payload, key, offset)
+                        if not channels or channel in channels:
+                            data = {"room_id": room_id, "provider": channel, "raw_object_key": key,
+                                    "raw_offset": offset, "raw_length": len(line)}
+                            rows.append(staging_row(extract_message(data, payload, received, line)))
+                offset += len(line) + 1
+        else:
+            # raw/{channel}/{room_id}/{ts}.json, the room id in the path is what the stream entry carried
+            channel, room_id = key[len("raw/"):].rsplit("/", 1)[0].split("/", 1)
+            try:
+                payload = fastjson.loads(body)
+            except ValueError:
+                continue
+            if isinstance(payload, dict):
+                data = {"room_id": room_id, "provider": channel, "raw_object_key": key}
+                rows.append(staging_row(extract_message(data, payload, received, body)))
+    return rows
+
+class Replay:
+    def __init__(self, args):
+        self.args = args
+        self.s3 = s3_client(max_pool_connections=args.fetch_concurrency)
+        self.fetch_executor = ThreadPoolExecutor(max_workers=args.fetch_concurrency)
+        self.parse_executor = ProcessPoolExecutor(max_workers=args.processes)
+        self.channels = set(args.channel or [])
+        self.objects = 0
+        self.messages = 0
+        self.inserted = 0
+
+    def list_prefixes(self):
+        """Listing prefixes to scan, narrowed by channel/date where the key layout allows it."""
+        if self.channels:
+            prefixes = [f"raw/{c}/" for c in sorted(self.channels)]
+        else:
+            prefixes = [p for p in self.common_prefixes("raw/") if p != "raw/batch/"]
+        if self.args.since and self.args.until:
+            day = self.args.since
+            while day <= self.args.until:
+                prefixes.append(f"raw/batch/{day.isoformat()}/")
+                day += datetime.timedelta(days=1)
+        else:
+            prefixes += [p for p in self.common_prefixes("raw/batch/") if self.day_in_range(p.split("/")[2])]
+        return prefixes
+
+    def common_prefixes(self, prefix):
+        found = []
+        for page in self.s3.get_paginator("list_objects_v2").paginate(Bucket=RAW_BUCKET, Prefix=prefix, Delimiter="/"):
+            found += [p["Prefix"] for p in page.get("CommonPrefixes", [])]
+        return found
+
+    def day_in_range(self, day):
+        if isinstance(day, str):
+            try:
+                day = datetime.date.fromisoformat(day)
+            except ValueError:
+                return False
+        return (not self.args.since or day >= self.args.since) and (not self.args.until or day <= self.args.until)
+
+    def in_range(self, key):
+        if not (self.args.since or self.args.until):
+            return True
+        ts = key_timestamp(key)
+        return ts is not None and self.day_in_range(ts.date())
+
+    def iter_chunks(self, prefix, start_after):
+        """Blocking generator of key lists, in key order, resuming after start_after."""
+        params = {"Bucket": RAW_BUCKET, "Prefix": prefix}
+        if start_after:
+            params["StartAfter"] = start_after
+        chunk = []
+        for page in self.s3.get_paginator("list_objects_v2").paginate(**params):
+            for obj in page.get("Contents", []):
+                chunk.append(obj["Key"])
+                if len(chunk) >= self.args.chunk_size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    def get_object(self, key):
+        try:
+            return self.s3.get_object(Bucket=RAW_BUCKET, Key=key)["Body"].read()
+        except self.s3.exceptions.NoSuchKey:
+            return None
+
+    async def fetch_and_parse(self, keys):
+        loop = asyncio.get_running_loop()
+        wanted = [k for k in keys if self.in_range(k)]
+        bodies = await asyncio.gather(*(loop.run_in_executor(self.fetch_executor, self.get_object, k) for k in wanted))
+        objects = [(k, b) for k, b in zip(wanted, bodies) if b is not None]
+
+        step = max(1, len(objects) // self.args.processes + 1)
+        parts = await asyncio.gather(*(
+            loop.run_in_executor(self.parse_executor, parse_objects, objects[i:i + step], self.channels)
+            for i in range(0, len(objects), step)
+        ))
+        return len(objects), [row for part in parts for row in part]
+
+    async def load_checkpoints(self, conn):
+        if not self.args.resume:
+            await conn.execute("DELETE FROM replay_checkpoint WHERE name=$1", self.args.name)
+            return {}
+        rows = await conn.fetch("SELECT prefix, last_key FROM replay_checkpoint WHERE name=$1", self.args.name)
+        return {r["prefix"]: r["last_key"] for r in rows}
+
+    async def produce(self, checkpoints, queue):
+        loop = asyncio.get_running_loop()
+        for prefix in await loop.run_in_executor(self.fetch_executor, self.list_prefixes):
+            chunks = self.iter_chunks(prefix, checkpoints.get(prefix))
+            while True:
+                keys = await loop.run_in_executor(self.fetch_executor, next, chunks, None)
+                if keys is None:
+                    break
+                await queue.put((prefix, keys[-1], asyncio.create_task(self.fetch_and_parse(keys))))
+        await queue.put(None)
+
+    async def load_chunk(self, conn, prefix, last_key, rows):
+        async with conn.transaction():
+            if rows:
+                await conn.execute("TRUNCATE replay_staging")
+                await conn.copy_records_to_table("replay_staging", records=rows, columns=STAGING_COLUMNS)
+                await conn.execute("""
+                    INSERT INTO rooms (room_id, channel, raw_meta, created_at, last_activity_at)
+                    SELECT room_key, min(channel), min(meta)::jsonb, min(created_at), now()
+                    FROM replay_staging
+                    GROUP BY room_key
+                    ON CONFLICT (room_id) DO UPDATE SET last_activity_at = EXCLUDED.last_activity_at
+                """)
+                # msg_id dedupes via the unique index; archived payloads without one are matched on content
+                status = await conn.execute("""
+                    INSERT INTO messages (room_id, msg_id, sender_type, sender_id, phone, content, raw_payload, created_at)
+                    SELECT r.id, s.msg_id, s.sender_type, s.sender_id, s.phone, s.content, s.raw_payload::jsonb, s.created_at
+                    FROM replay_staging s JOIN rooms r ON r.room_id = s.room_key
+                    WHERE s.msg_id IS NOT NULL OR NOT EXISTS (
+                        SELECT 1 FROM messages m
+                        WHERE m.room_id = r.id AND m.created_at = s.created_at AND m.content IS NOT DISTINCT FROM s.content
+                    )
+                    ON CONFLICT DO NOTHING
+                """)
+                self.inserted += int(status.split()[-1])
+            await conn.execute("""
+                INSERT INTO replay_checkpoint (name, prefix, last_key, updated_at)
+                VALUES ($1, $2, $3, now())
+                ON CONFLICT (name, prefix) DO UPDATE SET
+                    last_key = EXCLUDED.last_key,
+                    updated_at = EXCLUDED.updated_at
+            """, self.args.name, prefix, last_key)
+
+    async def run(self):
+        conn = await asyncpg.connect(DATABASE_URL)
+        started = time.perf_counter()
+        try:
+            await conn.execute("""
+                CREATE TEMP TABLE replay_staging (
+                    room_key text, channel text, meta text, msg_id text, sender_type text, sender_id text,
+                    phone text, content text, raw_payload text, created_at timestamptz
+                )
+            """)
+            queue = asyncio.Queue(maxsize=self.args.prefetch)
+            producer = asyncio.create_task(self.produce(await self.load_checkpoints(conn), queue))
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                prefix, last_key, task = item
+                objects, rows = await task
+                await self.load_chunk(conn, prefix, last_key, rows)
+                self.objects += objects
+                self.messages += len(rows)
+                elapsed = time.perf_counter() - started
+                log_event("replay_progress", prefix=prefix, last_key=last_key, objects=self.objects,
+                          messages=self.messages, inserted=self.inserted, msgs_per_s=round(self.messages / elapsed, 1))
+            await producer
+
+            if not self.args.no_rebuild:
+                await request_full_rebuild(conn)
+                log_event("replay_rebuild_requested")
+        finally:
+            await conn.close()
+            self.fetch_executor.shutdown(wait=False)
+            self.parse_executor.shutdown()
+
+        elapsed = time.perf_counter() - started
+        print(f"replayed {self.objects} objects, {self.messages} messages ({self.inserted} new) "
+              f"in {elapsed:.1f}s, {self.messages / max(elapsed, 1e-9):.0f} msgs/s")
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Rebuild rooms/messages from the MinIO raw archive")
+    ap.add_argument("--since", type=datetime.date.fromisoformat, help="first archive date (UTC), inclusive")
+    ap.add_argument("--until", type=datetime.date.fromisoformat, help="last archive date (UTC), inclusive")
+    ap.add_argument("--channel", action="append", help="only this channel (repeatable)")
+    ap.add_argument("--name", default="default", help="checkpoint name, one per replay job")
+    ap.add_argument("--resume", action="store_true", help="continue from the checkpoint of --name")
+    ap.add_argument("--no-rebuild", action="store_true", help="do not trigger the funnel full rebuild")
+    ap.add_argument("--chunk-size", type=int, default=REPLAY_CHUNK_SIZE)
+    ap.add_argument("--fetch-concurrency", type=int, default=REPLAY_FETCH_CONCURRENCY)
+    ap.add_argument("--processes", type=int, default=REPLAY_PROCESSES)
+    ap.add_argument("--prefetch", type=int, default=REPLAY_PREFETCH)
+    return ap.parse_args(argv)
+
+if __name__ == "__main__":
+    asyncio.run(Replay(parse_args()).run())
@@ -0,0 +1,88 @@
+import datetime
+from collections import OrderedDict
+from common.observability import log_event, metrics, timed
+
+
+class RoomCache:
+    """
+    Bounded LRU of external room_id -> (rooms.id, channel), plus the
+    last_activity_at bumps of cached rooms, coalesced in memory until
+    flush() writes them in one UPDATE.
+
+    A flush stamps the rooms with the flush time rather than the time their
+    messages were stored: those messages are committed by then, and a room
+    retried by a later flush would otherwise land behind the funnel ETL's
+    watermark and never be picked up by an incremental cycle.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.rooms = OrderedDict()
+        self.activity = {}
+
+    def get(self, room_key):
+        room = self.rooms.get(room_key)
+        if room is None:
+            metrics["worker_room_cache_lookups"].labels(result="miss").inc()
+            return None
+        self.rooms.move_to_end(room_key)
+        metrics["worker_room_cache_lookups"].labels(result="hit").inc()
+        return room
+
+    def put(self, room_key, room_id, channel):
+        self.rooms[room_key] = (room_id, channel)
+        self.rooms.move_to_end(room_key)
+        while len(self.rooms) > self.max_size:
+            self.rooms.popitem(last=False)
+        metrics["worker_room_cache_size"].set(len(self.rooms))
+
+    def clear(self):
+        # e.g. after a failed batch: a cached id may point at a room that no longer exists
+        self.rooms.clear()
+        metrics["worker_room_cache_size"].set(0)
+
+    def touch(self, room_id, ts):
+        last = self.activity.get(room_id)
+        if last is None or ts > last:
+            self.activity[room_id] = ts
+
+    async def flush(self, pool):
+        if not self.activity:
+            return 0
+        pending, self.activity = self.activity, {}
+        room_ids = sorted(pending)
+        flushed_at = datetime.datetime.utcnow()
+        try:
+            with timed("worker_stage_seconds", stage="activity_flush"):
+                async with pool.acquire() as conn:
+                    # never moved backwards; rows a batch transaction holds right now are
+                    # skipped (and retried next flush) instead of waiting on, or deadlocking with, it
+                    result = await conn.fetch("""
+                        WITH t AS (SELECT * FROM unnest($1::bigint[]) AS t(id)),
+                        locked AS (
+                            SELECT r.id FROM rooms r JOIN t ON t.id = r.id
+                            ORDER BY r.id FOR NO KEY UPDATE OF r SKIP LOCKED
+                        ),
+                        updated AS (
+                            UPDATE rooms AS r SET last_activity_at = GREATEST(r.last_activity_at, $2::timestamptz)
+                            FROM t JOIN locked ON locked.id = t.id
+                            WHERE r.id = t.id
+                            RETURNING r.id
+                        )
+                        SELECT r.id, r.id IN (SELECT id FROM updated) AS done
+                        FROM rooms r JOIN t ON t.id = r.id
+                    """, room_ids, flushed_at)
+        except Exception as e:
+            # keep them for the next flush
+            for room_id, ts in pending.items():
+                self.touch(room_id, ts)
+            log_event("activity_flush_error", error=str(e), rooms=len(pending))
+            return 0
+        done = 0
+        for r in result:
+            if r["done"]:
+                done += 1
+            else:
+                self.touch(r["id"], pending[r["id"]])
+        metrics["worker_activity_flush_rooms"].observe(done)
+        return done
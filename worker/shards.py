@@ -0,0 +1,128 @@
+import time, asyncio
+from collections import Counter
+from common.observability import log_event, metrics
+from common.streams import STREAM_BASE, STREAM_SHARDS, node_for, stream_key, stream_stats
+
+MEMBERS_KEY = f"{STREAM_BASE}:consumers"
+
+# renew only if we still own it / drop only our own lease
+RENEW_LEASE = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end return 0"
+RELEASE_LEASE = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+
+def lease_key(shard):
+    return f"{stream_key(shard)}:lease"
+
+
+class ShardAssigner:
+    """
+    Decides which streams this consumer reads.
+
+    Not sharded (STREAM_SHARDS=0): the single legacy stream, shared by all
+    consumers of the group as before.
+
+    Sharded: `static` shards when given (WORKER_SHARDS), otherwise lease
+    based. Live consumers heartbeat into a sorted set; shard s belongs to
+    the consumer at position s % live count, and is only read while this
+    consumer holds its lease key, so each room has one reader at a time.
+    A shard moving away is released once no read on it is in progress and
+    every entry already read from it is acked, then the next owner picks
+    it up from the group's position. Until the legacy stream is drained
+    (lag and pending both 0) only the legacy stream is read, which keeps
+    per-room order across the migration.
+    """
+
+    def __init__(self, redis, nodes, group, consumer_name, lanes, static=None, lease_ms=15000):
+        self.redis = redis
+        self.nodes = nodes
+        self.group = group
+        self.consumer_name = consumer_name
+        self.lanes = lanes
+        self.static = set(static) if static is not None else None
+        self.lease_ms = lease_ms
+        self.owned = set()
+        self.desired = set()
+        self.reading = Counter()
+        self.legacy = STREAM_SHARDS > 0
+        self.clients = {stream_key(s): nodes[node_for(s)] for s in range(STREAM_SHARDS)}
+        self.clients[STREAM_BASE] = redis
+
+    def client_for(self, stream):
+        return self.clients[stream]
+
+    def streams(self):
+        """[(redis client, stream key)] to read right now."""
+        if STREAM_SHARDS <= 0 or self.legacy:
+            return [(self.redis, STREAM_BASE)]
+        return [(self.clients[stream_key(s)], stream_key(s)) for s in sorted(self.owned & self.desired)]
+
+    async def ensure_group(self, client, stream):
+        try:
+            # "0" so entries pushed before the group existed are not skipped
+            await client.xgroup_create(stream, self.group, id="0", mkstream=True)
+        except Exception:
+            pass
+
+    async def check_legacy(self):
+        try:
+            _, lag, pending = await stream_stats(self.redis, STREAM_BASE, self.group)
+        except Exception:
+            # no legacy stream at all
+            lag = pending = 0
+        if lag == 0 and pending == 0:
+            self.legacy = False
+            log_event("legacy_stream_drained", stream=STREAM_BASE)
+
+    async def wanted(self):
+        if self.static is not None:
+            return self.static
+        now = int(time.time() * 1000)
+        await self.redis.zadd(MEMBERS_KEY, {self.consumer_name: now})
+        await self.redis.zremrangebyscore(MEMBERS_KEY, "-inf", now - self.lease_ms)
+        # ordered by name, not heartbeat time, so every consumer computes the same split
+        live = sorted(m.decode() if isinstance(m, bytes) else m for m in await self.redis.zrange(MEMBERS_KEY, 0, -1))
+        if self.consumer_name not in live:
+            return set()
+        index = live.index(self.consumer_name)
+        return {s for s in range(STREAM_SHARDS) if s % len(live) == index}
+
+    async def tick(self):
+        if STREAM_SHARDS <= 0:
+            return
+        if self.legacy:
+            await self.check_legacy()
+        self.desired = await self.wanted()
+
+        for shard in sorted(self.owned - self.desired):
+            stream = stream_key(shard)
+            if self.reading[stream] or self.lanes.inflight_for(stream):
+                continue
+            if self.static is None:
+                await self.redis.eval(RELEASE_LEASE, 1, lease_key(shard), self.consumer_name)
+            self.owned.discard(shard)
+            log_event("shard_released", shard=shard, consumer=self.consumer_name)
+
+        # draining shards too: their lease must outlive the drain
+        for shard in sorted(self.owned):
+            if self.static is None and not await self.redis.eval(RENEW_LEASE, 1, lease_key(shard), self.consumer_name, self.lease_ms):
+                # expired (e.g. we stalled longer than the lease) and maybe taken over
+                self.owned.discard(shard)
+                log_event("shard_lease_lost", shard=shard, consumer=self.consumer_name)
+
+        for shard in sorted(self.desired - self.owned):
+            if self.static is None and not await self.redis.set(lease_key(shard), self.consumer_name, nx=True, px=self.lease_ms):
+                # previous owner still draining it
+                continue
+            await self.ensure_group(self.clients[stream_key(shard)], stream_key(shard))
+            self.owned.add(shard)
+            log_event("shard_acquired", shard=shard, consumer=self.consumer_name)
+
+        metrics["worker_shards_owned"].set(len(self.owned & self.desired))
+
+    async def run(self, interval):
+        while True:
+            try:
+                await self.tick()
+            except Exception as e:
+                log_event("shard_assign_error", error=str(e))
+            await asyncio.sleep(interval)
@@ -1,9 +1,18 @@
-import os, asyncio, json, datetime
-import asyncpg, boto3
-import redis.asyncio as redis_lib
+import os, time, asyncio, zlib, datetime
+from collections import Counter
+import boto3
 from botocore.client import Config
+from dateutil import parser as dateparser
 import logging
-from utils.observability import log_event, metrics, start_metrics_server
+from common.observability import log_event, metrics, start_metrics_server, timed
+from common import fastjson, profiling
+from common.resources import get_db_pool, get_redis, watch_resources
+from common.funnel import ROLLUP_VERSION_KEY, advance_funnel
+from common.keyword_matcher import get_keyword_matcher
+from common.streams import STREAM_BASE, STREAM_GROUP, STREAM_REDIS_URLS, STREAM_SHARDS
+from backlog import BacklogManager
+from shards import ShardAssigner
+from room_cache import RoomCache
 
 logging.basicConfig(
     level=logging.INFO,
@@ -17,89 +26,548 @@ MINIO_ENDPOINT = os.getenv("MINIO_ENDPOINT")
 MINIO_ACCESS_KEY = os.getenv("MINIO_ACCESS_KEY")
 MINIO_SECRET_KEY = os.getenv("MINIO_SECRET_KEY")
 RAW_BUCKET = os.getenv("RAW_BUCKET", "raw-payloads")
+# entries pulled per xreadgroup call and written per DB transaction
+WORKER_BATCH_SIZE = int(os.getenv("WORKER_BATCH_SIZE", "200"))
+# upper bound for xreadgroup count while catching up on lag
+WORKER_MAX_BATCH_SIZE = int(os.getenv("WORKER_MAX_BATCH_SIZE", "2000"))
+# pending entries idle this long (ms) are XAUTOCLAIMed from dead consumers
+RECLAIM_IDLE_MS = int(os.getenv("RECLAIM_IDLE_MS", "60000"))
+BACKLOG_POLL_SECONDS = float(os.getenv("BACKLOG_POLL_SECONDS", "5"))
+# concurrent lanes (rooms are pinned to one lane to keep per-room order)
+WORKER_LANES = int(os.getenv("WORKER_LANES", "8"))
+# entries read from the stream but not yet acked, across all lanes
+WORKER_MAX_INFLIGHT = int(os.getenv("WORKER_MAX_INFLIGHT", "1000"))
+# consumer processes per container, all in the same consumer group
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "1"))
+# process N exposes metrics on METRICS_PORT + N
+METRICS_PORT = int(os.getenv("METRICS_PORT", "7001"))
+# "1" = update the funnel row of each room as its messages are stored (funnel-etl then only reconciles)
+FUNNEL_STREAMING = os.getenv("FUNNEL_STREAMING", "0") == "1"
+# min seconds between funnel:rollup:version bumps from streaming updates (report cache invalidation)
+FUNNEL_VERSION_INTERVAL = float(os.getenv("FUNNEL_VERSION_INTERVAL", "1"))
+# what messages.raw_payload keeps: full = the whole payload, ref = only its MinIO location
+# ({"object_key", "offset", "length"}), none = NULL (the archive is the source of truth)
+RAW_PAYLOAD_MODE = os.getenv("RAW_PAYLOAD_MODE", "full")
+# external room_id -> rooms.id entries kept per process (0 = no cache, every batch upserts its rooms)
+ROOM_CACHE_SIZE = int(os.getenv("ROOM_CACHE_SIZE", "50000"))
+# cached rooms' last_activity_at bumps are written in bulk this often; must stay below the
+# ETL's WATERMARK_OVERLAP_SECONDS (same env, checked at startup) so incremental cycles never miss a room
+ACTIVITY_FLUSH_SECONDS = float(os.getenv("ACTIVITY_FLUSH_SECONDS", "1"))
+WATERMARK_OVERLAP_SECONDS = int(os.getenv("WATERMARK_OVERLAP_SECONDS", "5"))
+# sharded streams (STREAM_SHARDS > 0): fixed shards for this worker, e.g. "0,1,2"; empty = lease based rebalancing
+WORKER_SHARDS = os.getenv("WORKER_SHARDS", "")
+# a shard lease (and a consumer's membership) expires after this long without renewal
+SHARD_LEASE_MS = int(os.getenv("SHARD_LEASE_MS", "15000"))
+SHARD_REBALANCE_SECONDS = float(os.getenv("SHARD_REBALANCE_SECONDS", "3"))
 
-def s3_client():
+def s3_client(max_pool_connections=10):
     session = boto3.session.Session()
     return session.client(
         "s3",
         endpoint_url=f"http://{MINIO_ENDPOINT}",
         aws_access_key_id=MINIO_ACCESS_KEY,
         aws_secret_access_key=MINIO_SECRET_KEY,
-        config=Config(signature_version="s3v4"),
+        config=Config(signature_version="s3v4", max_pool_connections=max_pool_connections),
     )
 
-async def process_entry(pool, s3, entry):
-    from dateutil import parser as dateparser
+def decode_fields(entry):
+    # raw_payload stays bytes, it may be zlib compressed
+    return {k.decode(): v if k == b"raw_payload" else v.decode() for k,v in entry.items()}
 
-    data = {k.decode(): v.decode() for k,v in entry.items()}
-    key = data.get("raw_object_key")
-    room_key = data.get("room_id")
-    provider = data.get("provider")
+def read_s3_object(s3, key, offset=None, length=None):
+    with timed("worker_stage_seconds", stage="s3_get"):
+        if offset is None:
+            obj = s3.get_object(Bucket=RAW_BUCKET, Key=key)
+        else:
+            # one payload inside a /webhook/batch segment object
+            obj = s3.get_object(Bucket=RAW_BUCKET, Key=key, Range=f"bytes={offset}-{offset + length - 1}")
+        return obj["Body"].read()
 
+async def fetch_payload(s3, data):
+    """
+    Small payloads are inlined in the stream entry by the API; only large
+    ones need the MinIO round trip (run off the event loop). Returns
+    (payload, original bytes), bytes None when the payload is unreadable.
+    """
     try:
-        obj = s3.get_object(Bucket=RAW_BUCKET, Key=key)
-        raw_bytes = obj["Body"].read()
-        payload = json.loads(raw_bytes)
+        raw_bytes = data.get("raw_payload")
+        if raw_bytes:
+            if data.get("payload_encoding") == "zlib":
+                raw_bytes = zlib.decompress(raw_bytes)
+        else:
+            offset = data.get("raw_offset")
+            length = data.get("raw_length")
+            raw_bytes = await asyncio.to_thread(
+                read_s3_object, s3, data.get("raw_object_key"),
+                int(offset) if offset is not None else None,
+                int(length) if length is not None else None,
+            )
+        return fastjson.loads(raw_bytes), raw_bytes
     except Exception:
-        payload = {"provider": provider, "room_id": room_key}
+        return {"provider": data.get("provider"), "room_id": data.get("room_id")}, None
 
-    async with pool.acquire() as conn:
-        now = datetime.datetime.utcnow()
-        r = await conn.fetchrow("SELECT id FROM rooms WHERE room_id=$1", room_key)
-        if r:
-            room_id = r["id"]
-            await conn.execute("UPDATE rooms SET last_activity_at=$1 WHERE id=$2", now, room_id)
-        else:
-            row = await conn.fetchrow("INSERT INTO rooms (room_id, channel, raw_meta, created_at, last_activity_at) VALUES ($1,$2,$3,$4,$5) RETURNING id",
-                                      room_key, payload.get("channel","unknown"), json.dumps(payload.get("meta") or {}), now, now)
-            room_id = row["id"]
+def parse_timestamp(value, now):
+    """
+    Payload timestamp -> datetime. ISO-8601 strings (what providers and the
+    load generator send) take the fromisoformat fast path, anything else
+    goes through dateutil; unparseable values fall back to `now`.
+    """
+    if not value:
+        return now
+    if isinstance(value, str):
+        try:
+            return datetime.datetime.fromisoformat(value)
+        except ValueError:
+            pass
+    try:
+        return dateparser.parse(value)
+    except (ValueError, OverflowError, TypeError):
+        return now
+
+def raw_payload_value(data, payload, raw=None):
+    if RAW_PAYLOAD_MODE == "none":
+        return None
+    key = data.get("raw_object_key")
+    if RAW_PAYLOAD_MODE == "ref" and key:
+        ref = {"object_key": key}
+        if data.get("raw_offset") is not None:
+            ref["offset"] = int(data["raw_offset"])
+            ref["length"] = int(data["raw_length"])
+        return fastjson.dumps(ref)
+    if raw is not None:
+        # stored verbatim, jsonb parses it once on the server
+        try:
+            return raw.decode("utf-8-sig")
+        except UnicodeDecodeError:
+            pass
+    return fastjson.dumps(payload)
+
+def extract_message(data, payload, now, raw=None):
+    """
+    Flatten a stream entry + its raw payload into the columns we store.
+    `raw` is the payload's original bytes, kept as raw_payload when given.
+    """
+    message = payload.get("message",{}) or {}
+    sender = payload.get("sender",{}) or {}
+    meta = payload.get("meta")
+
+    return {
+        "room_key": data.get("room_id"),
+        "channel": payload.get("channel","unknown"),
+        "meta": fastjson.dumps(meta) if meta else "{}",
+        "msg_id": message.get("id") or payload.get("msg_id"),
+        "sender_type": sender.get("type") or payload.get("sender_type"),
+        "sender_id": sender.get("id"),
+        "phone": sender.get("phone") or payload.get("phone"),
+        "content": message.get("text") or fastjson.dumps(payload.get("message") or {}),
+        "raw_payload": raw_payload_value(data, payload, raw),
+        "created_at": parse_timestamp(payload.get("timestamp"), now),
+    }
 
-        msg_id = payload.get("message",{}).get("id") or payload.get("msg_id")
-        sender = payload.get("sender",{}) or {}
-        content = payload.get("message",{}).get("text") or json.dumps(payload.get("message") or {})
+def funnel_message(row):
+    # the same fields the ETL reads back from `messages` (raw_payload as jsonb text)
+    return {
+        "content": row["content"],
+        "phone": row["phone"],
+        "raw_payload": row["raw_payload"],
+        "created_at": row["created_at"],
+    }
+
+async def update_funnel(conn, rows, room_ids, channels, matcher):
+    """
+    Streaming mode: fold this batch into the funnel rows of its rooms. Runs in
+    the storing transaction, which already holds the rooms row locks.
+    """
+    room_messages = {}
+    for r in rows:
+        room_messages.setdefault(room_ids[r["room_key"]], []).append(funnel_message(r))
+    with timed("worker_stage_seconds", stage="funnel_update"):
+        updated = await advance_funnel(conn, room_messages, channels, matcher)
+    metrics["worker_funnel_rooms_updated"].inc(updated)
+
+# hot statements, served from asyncpg's per-connection statement cache (DB_STATEMENT_CACHE_SIZE)
+ROOM_LOOKUP = "SELECT id, channel FROM rooms WHERE room_id=$1"
+ROOM_TOUCH = "UPDATE rooms SET last_activity_at=$1 WHERE id=$2"
+ROOM_INSERT = """
+    INSERT INTO rooms (room_id, channel, raw_meta, created_at, last_activity_at) VALUES ($1,$2,$3,$4,$5)
+    RETURNING id, channel
+"""
+MESSAGE_INSERT = """
+    INSERT INTO messages (room_id, msg_id, sender_type, sender_id, phone, content, raw_payload, created_at)
+    VALUES ($1,$2,$3,$4,$5,$6,$7,$8)
+"""
+ROOMS_LOCK = """
+    SELECT id, room_id, channel FROM rooms WHERE room_id = ANY($1::text[])
+    ORDER BY room_id FOR NO KEY UPDATE
+"""
+ROOMS_UPSERT = """
+    INSERT INTO rooms (room_id, channel, raw_meta, created_at, last_activity_at)
+    SELECT room_id, channel, raw_meta::jsonb, $4, $4
+    FROM unnest($1::text[], $2::text[], $3::text[]) AS t(room_id, channel, raw_meta)
+    ON CONFLICT (room_id) DO UPDATE SET last_activity_at = EXCLUDED.last_activity_at
+    RETURNING id, room_id, channel
+"""
+MESSAGES_INSERT = """
+    INSERT INTO messages (room_id, msg_id, sender_type, sender_id, phone, content, raw_payload, created_at)
+    SELECT room_id, msg_id, sender_type, sender_id, phone, content, raw_payload::jsonb, created_at
+    FROM unnest($1::bigint[], $2::text[], $3::text[], $4::text[], $5::text[], $6::text[], $7::text[], $8::timestamptz[])
+        AS t(room_id, msg_id, sender_type, sender_id, phone, content, raw_payload, created_at)
+    ON CONFLICT DO NOTHING
+    RETURNING room_id, msg_id
+"""
+
+async def process_entry(pool, s3, entry, matcher=None, rooms=None):
+    data = decode_fields(entry)
+    now = datetime.datetime.utcnow()
+    payload, raw = await fetch_payload(s3, data)
+    row = extract_message(data, payload, now, raw)
+
+    async with pool.acquire() as conn:
+        with timed("worker_stage_seconds", stage="room_upsert"):
+            cached = rooms.get(row["room_key"]) if rooms is not None else None
+            if cached:
+                room_id, channel = cached
+                rooms.touch(room_id, now)
+            else:
+                r = await conn.fetchrow(ROOM_LOOKUP, row["room_key"])
+                if r:
+                    if rooms is not None:
+                        rooms.touch(r["id"], now)
+                    else:
+                        await conn.execute(ROOM_TOUCH, now, r["id"])
+                else:
+                    r = await conn.fetchrow(ROOM_INSERT, row["room_key"], row["channel"], row["meta"], now, now)
+                room_id, channel = r["id"], r["channel"]
+                if rooms is not None:
+                    rooms.put(row["room_key"], room_id, channel)
 
         try:
-            timestamp_str = payload.get("timestamp")
-            created_at = dateparser.parse(timestamp_str) if timestamp_str else now
-            await conn.execute(
-                "INSERT INTO messages (room_id, msg_id, sender_type, sender_id, phone, content, raw_payload, created_at) VALUES ($1,$2,$3,$4,$5,$6,$7,$8)",
-                room_id, msg_id, sender.get("type") or payload.get("sender_type"), sender.get("id"),
-                sender.get("phone") or payload.get("phone"), content, json.dumps(payload), created_at
-            )
+            with timed("worker_stage_seconds", stage="message_insert"):
+                await conn.execute(
+                    MESSAGE_INSERT,
+                    room_id, row["msg_id"], row["sender_type"], row["sender_id"],
+                    row["phone"], row["content"], row["raw_payload"], row["created_at"]
+                )
         except Exception as e:
             print(e, "<< error cuy")
-            pass
+            return
 
+        if matcher is not None:
+            async with conn.transaction():
+                # lock the room like the batch path does, so ETL and other workers don't interleave
+                await conn.execute("SELECT 1 FROM rooms WHERE id=$1 FOR NO KEY UPDATE", room_id)
+                await update_funnel(conn, [row], {row["room_key"]: room_id}, {room_id: channel}, matcher)
+
+def inserted_rows(rows, room_ids, returned):
+    """
+    The rows MESSAGES_INSERT actually wrote, in batch order: a redelivered
+    message skipped by ON CONFLICT must not be folded into the funnel again.
+    Rows without msg_id always insert; of repeats within the batch the first
+    ones are taken.
+    """
+    left = Counter((r["room_id"], r["msg_id"]) for r in returned if r["msg_id"] is not None)
+    kept = []
+    for r in rows:
+        if r["msg_id"] is not None:
+            key = (room_ids[r["room_key"]], r["msg_id"])
+            if not left[key]:
+                continue
+            left[key] -= 1
+        kept.append(r)
+    return kept
+
+async def store_batch(pool, rows, now, matcher=None, rooms=None):
+    """
+    Persist a batch of extracted messages in one transaction: one upsert for
+    the distinct rooms not already known (room cache, or the row locks taken
+    when streaming), one insert for all messages (duplicates skipped by the
+    msg_id unique index, on plain and partitioned messages alike), plus the
+    funnel update of the messages actually inserted when streaming (matcher
+    given). Known rooms get their last_activity_at bump through the cache's
+    flush.
+    """
+    first = {}
+    for r in rows:
+        first.setdefault(r["room_key"], r)
+    # rooms are locked in key order so concurrent batches can't deadlock
+    keys = sorted(first)
+    room_ids = {}
+    channels = {}
+    if rooms is not None:
+        for key in keys:
+            room = rooms.get(key)
+            if room:
+                room_ids[key] = room[0]
+                channels[room[0]] = room[1]
+
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            with timed("worker_stage_seconds", stage="room_upsert"):
+                if rooms is not None and matcher is not None:
+                    # the funnel update needs the rooms row locks: take them for every existing
+                    # room of the batch, cached or not, in the same key order as the upsert
+                    for r in await conn.fetch(ROOMS_LOCK, keys):
+                        room_ids[r["room_id"]] = r["id"]
+                        channels[r["id"]] = r["channel"]
+                known = list(room_ids)
+                missing = {key: first[key] for key in keys if key not in room_ids}
+                if missing:
+                    room_rows = await conn.fetch(ROOMS_UPSERT, list(missing), [r["channel"] for r in missing.values()], [r["meta"] for r in missing.values()], now)
+                    for r in room_rows:
+                        room_ids[r["room_id"]] = r["id"]
+                        channels[r["id"]] = r["channel"]
+
+            with timed("worker_stage_seconds", stage="message_insert"):
+                inserted = await conn.fetch(MESSAGES_INSERT,
+                [room_ids[r["room_key"]] for r in rows],
+                [r["msg_id"] for r in rows],
+                [r["sender_type"] for r in rows],
+                [r["sender_id"] for r in rows],
+                [r["phone"] for r in rows],
+                [r["content"] for r in rows],
+                [r["raw_payload"] for r in rows],
+                [r["created_at"] for r in rows],
+                )
+
+            if matcher is not None:
+                fresh = inserted_rows(rows, room_ids, inserted)
+                if fresh:
+                    await update_funnel(conn, fresh, room_ids, channels, matcher)
+
+    if rooms is not None:
+        for key in keys:
+            rooms.put(key, room_ids[key], channels[room_ids[key]])
+        # rooms that skipped the upsert get their last_activity_at bump through the cache
+        for key in known:
+            rooms.touch(room_ids[key], now)
+
+async def process_batch(pool, s3, entries, matcher=None, rooms=None):
+    """
+    Batch path for a whole xreadgroup result. Falls back to one-by-one
+    processing if the batch transaction fails, so one bad entry can't
+    block the rest.
+    """
+    now = datetime.datetime.utcnow()
+    datas = [decode_fields(fields) for _, fields in entries]
+    payloads = await asyncio.gather(*(fetch_payload(s3, data) for data in datas))
+    rows = [extract_message(data, payload, now, raw) for data, (payload, raw) in zip(datas, payloads)]
 
-async def consumer():
-    s3 = s3_client()
-    pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=10)
-    redis = await redis_lib.from_url(REDIS_URL)
-    stream = "incoming:messages"
-    group = "workers"
-    consumer_name = f"worker-{os.getenv('HOSTNAME','1')}"
-    start_metrics_server(port=7001) 
     try:
-        await redis.xgroup_create(stream, group, id="$", mkstream=True)
-    except Exception:
-        pass
-    pending = await redis.xpending(stream, group)
-    log_event("pending_check", stream=stream, pending_count=pending['pending'])
-    while True:
+        await store_batch(pool, rows, now, matcher, rooms)
+    except Exception as e:
+        log_event("batch_store_error", error=str(e), size=len(entries))
+        if rooms is not None:
+            rooms.clear()
+        for _, fields in entries:
+            await process_entry(pool, s3, fields, matcher, rooms)
+
+def observe_end_to_end(entries):
+    now = datetime.datetime.utcnow()
+    for _, fields in entries:
+        received_at = fields.get(b"received_at")
+        if not received_at:
+            continue
         try:
-            resp = await redis.xreadgroup(group, consumer_name, streams={stream: ">"}, count=10, block=5000)
-            if not resp:
-                await asyncio.sleep(0.2)
+            received = datetime.datetime.fromisoformat(received_at.decode())
+        except ValueError:
+            continue
+        metrics["worker_end_to_end_seconds"].observe(max((now - received).total_seconds(), 0))
+
+class Lanes:
+    """
+    Per-room ordered concurrency. Entries are sharded by room_id onto
+    `count` lanes: a lane applies its entries in arrival order, different
+    lanes run in parallel. At most `max_inflight` entries may be read but
+    not yet acked; past that submit() waits, which pauses xreadgroup.
+    """
+
+    def __init__(self, count, max_inflight, handler):
+        self.queues = [asyncio.Queue() for _ in range(count)]
+        self.inflight = asyncio.Semaphore(max_inflight)
+        self.handler = handler
+        self.tasks = []
+        # (stream, entry id): ids are only unique within one stream
+        self.inflight_ids = set()
+        self.inflight_streams = Counter()
+
+    def start(self):
+        for lane in range(len(self.queues)):
+            self.tasks.append(asyncio.create_task(self._run(lane)))
+
+    def is_inflight(self, stream, msg_id):
+        return (stream, msg_id) in self.inflight_ids
+
+    def inflight_for(self, stream):
+        return self.inflight_streams[stream]
+
+    def lane_for(self, fields):
+        return zlib.crc32(fields.get(b"room_id", b"")) % len(self.queues)
+
+    async def submit(self, stream, msg_id, fields):
+        await self.inflight.acquire()
+        self.inflight_ids.add((stream, msg_id))
+        self.inflight_streams[stream] += 1
+        metrics["worker_inflight_messages"].inc()
+        lane = self.lane_for(fields)
+        self.queues[lane].put_nowait((stream, msg_id, fields))
+        metrics["worker_lane_queue_depth"].labels(lane=str(lane)).set(self.queues[lane].qsize())
+
+    async def _run(self, lane):
+        queue = self.queues[lane]
+        label = str(lane)
+        while True:
+            entries = [await queue.get()]
+            while len(entries) < WORKER_BATCH_SIZE and not queue.empty():
+                entries.append(queue.get_nowait())
+            metrics["worker_lane_queue_depth"].labels(lane=label).set(queue.qsize())
+
+            metrics["worker_lane_busy"].labels(lane=label).set(1)
+            started = time.perf_counter()
+            try:
+                await self.handler(entries)
+            except Exception as e:
+                # left un-acked, so the entries stay in the group's pending list
+                log_event("lane_error", lane=lane, error=str(e), size=len(entries))
+            finally:
+                metrics["worker_lane_busy_seconds"].labels(lane=label).inc(time.perf_counter() - started)
+                metrics["worker_lane_busy"].labels(lane=label).set(0)
+                metrics["worker_inflight_messages"].dec(len(entries))
+                for stream, msg_id, _ in entries:
+                    self.inflight_ids.discard((stream, msg_id))
+                    self.inflight_streams[stream] -= 1
+                    self.inflight.release()
+
+async def consumer(index=0):
+    s3 = s3_client()
+    pool = await get_db_pool("worker", default_max=max(10, WORKER_LANES + 2), url=DATABASE_URL)
+    redis = get_redis(REDIS_URL)
+    # Redis nodes holding the stream shards (just REDIS_URL unless STREAM_REDIS_URLS is set)
+    nodes = [get_redis(url) for url in STREAM_REDIS_URLS] or [redis]
+    group = STREAM_GROUP
+    consumer_name = f"worker-{os.getenv('HOSTNAME','1')}"
+    if WORKER_PROCESSES > 1:
+        consumer_name += f"-{index}"
+    start_metrics_server(port=METRICS_PORT + index)
+
+    funnel_dirty = asyncio.Event()
+    rooms = RoomCache(ROOM_CACHE_SIZE) if ROOM_CACHE_SIZE > 0 else None
+
+    async def bump_funnel_version():
+        # coalesced so the API report cache is invalidated at most every FUNNEL_VERSION_INTERVAL
+        while True:
+            await funnel_dirty.wait()
+            funnel_dirty.clear()
+            try:
+                await redis.incr(ROLLUP_VERSION_KEY)
+            except Exception as e:
+                log_event("funnel_version_error", error=str(e))
+            await asyncio.sleep(FUNNEL_VERSION_INTERVAL)
+
+    async def flush_activity():
+        while True:
+            await asyncio.sleep(ACTIVITY_FLUSH_SECONDS)
+            await rooms.flush(pool)
+
+    async def handle(entries):
+        matcher = await get_keyword_matcher(redis) if FUNNEL_STREAMING else None
+        batch = [(msg_id, fields) for _, msg_id, fields in entries]
+        await process_batch(pool, s3, batch, matcher, rooms)
+        if FUNNEL_STREAMING:
+            funnel_dirty.set()
+        acks = {}
+        for stream, msg_id, _ in entries:
+            acks.setdefault(stream, []).append(msg_id)
+        for stream, msg_ids in acks.items():
+            await assigner.client_for(stream).xack(stream, group, *msg_ids)
+            for msg_id in msg_ids:
+                log_event("message_ack", stream=stream, msg_id=msg_id)
+        metrics["redis_messages_ack"].inc(len(entries))
+        observe_end_to_end(batch)
+
+    async def read_node(client):
+        while True:
+            streams = [stream for c, stream in assigner.streams() if c is client]
+            if not streams:
+                await asyncio.sleep(1)
                 continue
-            for stream_name, messages in resp:
-                for msg_id, fields in messages:
-                    await process_entry(pool, s3, fields)
-                    await redis.xack(stream, group, msg_id)
-                    metrics.setdefault("redis_messages_ack", metrics["redis_messages_ack"].inc())
-                    log_event("message_ack", stream=stream, msg_id=msg_id)
-        except Exception as e:
-            print("worker error:", e)
-            await asyncio.sleep(1)
+            assigner.reading.update(streams)
+            try:
+                count, block = backlog.read_params()
+                resp = await client.xreadgroup(group, consumer_name, streams={s: ">" for s in streams}, count=count, block=block)
+                if not resp:
+                    await asyncio.sleep(0.2)
+                    continue
+                for stream_name, messages in resp:
+                    stream_name = stream_name.decode() if isinstance(stream_name, bytes) else stream_name
+                    for msg_id, fields in messages:
+                        await lanes.submit(stream_name, msg_id, fields)
+            except Exception as e:
+                print("worker error:", e)
+                await asyncio.sleep(1)
+            finally:
+                assigner.reading.subtract(streams)
+
+    lanes = Lanes(WORKER_LANES, WORKER_MAX_INFLIGHT, handle)
+    lanes.start()
+    static = [int(s) for s in WORKER_SHARDS.split(",") if s.strip()] if WORKER_SHARDS else None
+    assigner = ShardAssigner(redis, nodes, group, consumer_name, lanes, static=static, lease_ms=SHARD_LEASE_MS)
+    if STREAM_SHARDS <= 0:
+        await assigner.ensure_group(redis, STREAM_BASE)
+        pending = await redis.xpending(STREAM_BASE, group)
+        metrics["redis_messages_pending"].set(pending['pending'])
+        log_event("pending_check", stream=STREAM_BASE, pending_count=pending['pending'])
+    await assigner.tick()
+    # referenced here so they live as long as the readers, cancelled when those exit
+    background = {asyncio.create_task(assigner.run(SHARD_REBALANCE_SECONDS))}
+    backlog = BacklogManager(
+        assigner.streams, group, consumer_name, lanes,
+        base_count=WORKER_BATCH_SIZE,
+        max_count=WORKER_MAX_BATCH_SIZE,
+        idle_ms=RECLAIM_IDLE_MS,
+        interval=BACKLOG_POLL_SECONDS,
+    )
+    background.add(asyncio.create_task(backlog.run()))
+    background.add(asyncio.create_task(watch_resources()))
+    lag_monitor = profiling.install("worker")
+    if lag_monitor is not None:
+        background.add(lag_monitor)
+    if FUNNEL_STREAMING:
+        background.add(asyncio.create_task(bump_funnel_version()))
+    if rooms is not None:
+        background.add(asyncio.create_task(flush_activity()))
+    log_event("worker_started", consumer=consumer_name, lanes=WORKER_LANES, max_inflight=WORKER_MAX_INFLIGHT,
+              funnel_streaming=FUNNEL_STREAMING, room_cache_size=ROOM_CACHE_SIZE,
+              stream_shards=STREAM_SHARDS, static_shards=static)
+
+    # one reader per Redis node, each reading the streams this consumer owns there
+    try:
+        await asyncio.gather(*(read_node(client) for client in {id(c): c for c in [redis, *nodes]}.values()))
+    finally:
+        for task in background:
+            task.cancel()
+
+def run_process(index):
+    asyncio.run(consumer(index))
+
+def check_config():
+    if ROOM_CACHE_SIZE > 0 and ACTIVITY_FLUSH_SECONDS >= WATERMARK_OVERLAP_SECONDS:
+        raise SystemExit(
+            f"ACTIVITY_FLUSH_SECONDS ({ACTIVITY_FLUSH_SECONDS}) must be below the funnel ETL's "
+            f"WATERMARK_OVERLAP_SECONDS ({WATERMARK_OVERLAP_SECONDS})"
+        )
+    if WORKER_PROCESSES > 1 and STREAM_SHARDS <= 0:
+        # the group hands entries of one room to any process: lanes only order within a process
+        log_event("worker_config_warning", warning="per-room ordering needs STREAM_SHARDS > 0 with WORKER_PROCESSES > 1",
+                  worker_processes=WORKER_PROCESSES)
 
 if __name__ == "__main__":
-    asyncio.run(consumer())
+    check_config()
+    if WORKER_PROCESSES > 1:
+        import multiprocessing
+        procs = [multiprocessing.Process(target=run_process, args=(i,), daemon=True) for i in range(WORKER_PROCESSES)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+    else:
+        asyncio.run(consumer())